@@ -1,5 +1,8 @@
-from .blind_watermark import WaterMark
+from .blind_watermark import WaterMark, RawExtraction
 from .bwm_core import WaterMarkCore
 from .att import *
 from .recover import recover_crop
+from .key_cache import key_cache
+from .pool import close_pools
+from .stage_stats import StageStats
 from .version import __version__, bw_notes
@@ -6,6 +6,19 @@ import numpy as np
 import warnings
 
 
+def get_rng(seed=None):
+    # seed 为空时沿用 np.random 的全局状态（可以用 np.random.seed 复现），否则用独立的随机数生成器
+    return np.random if seed is None else np.random.RandomState(seed)
+
+
+def get_loc(loc_r, loc, shape):
+    # 剪切位置：loc=(x1, y1, x2, y2) 优先，否则由比例 loc_r=((x1, y1), (x2, y2)) 和图片尺寸得出
+    if loc is not None:
+        return loc
+    h, w = shape[:2]
+    return int(w * loc_r[0][0]), int(h * loc_r[0][1]), int(w * loc_r[1][0]), int(h * loc_r[1][1])
+
+
 def cut_att3(input_filename=None, input_img=None, output_file_name=None, loc_r=None, loc=None, scale=None):
     # 剪切攻击 + 缩放攻击
     if input_filename:
@@ -48,29 +61,35 @@ def resize_att(input_filename=None, input_img=None, output_file_name=None, out_s
 def bright_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.8):
     # 亮度调整攻击，ratio应当多于0
     # ratio>1是调得更亮，ratio<1是亮度更暗
+    # uint8 图片直接得到取整、截断后的 uint8 结果，不产生 float 副本
     if input_filename:
         input_img = cv2.imread(input_filename)
-    output_img = input_img * ratio
-    output_img[output_img > 255] = 255
+    if input_img.dtype == np.uint8:
+        output_img = cv2.convertScaleAbs(input_img, alpha=ratio)
+    else:
+        output_img = input_img * ratio
+        output_img[output_img > 255] = 255
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def shelter_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.1, n=3):
+def shelter_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.1, n=3, seed=None):
     # 遮挡攻击：遮挡图像中的一部分
     # n个遮挡块
     # 每个遮挡块所占比例为ratio
+    # seed 不为空时遮挡位置可复现
     if input_filename:
         output_img = cv2.imread(input_filename)
     else:
         output_img = input_img.copy()
     input_img_shape = output_img.shape
+    rng = get_rng(seed)
 
     for i in range(n):
-        tmp = np.random.rand() * (1 - ratio)  # 随机选择一个地方，1-ratio是为了防止溢出
+        tmp = rng.rand() * (1 - ratio)  # 随机选择一个地方，1-ratio是为了防止溢出
         start_height, end_height = int(tmp * input_img_shape[0]), int((tmp + ratio) * input_img_shape[0])
-        tmp = np.random.rand() * (1 - ratio)
+        tmp = rng.rand() * (1 - ratio)
         start_width, end_width = int(tmp * input_img_shape[1]), int((tmp + ratio) * input_img_shape[1])
 
         output_img[start_height:end_height, start_width:end_width, :] = 255
@@ -80,16 +99,24 @@ def shelter_att(input_filename=None, input_img=None, output_file_name=None, rati
     return output_img
 
 
-def salt_pepper_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.01):
-    # 椒盐攻击
+def salt_pepper_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.01, seed=None):
+    # 椒盐攻击：每个像素以 ratio 的概率置为白色
+    # 一次生成整张图的随机数，与逐像素调用 np.random.rand() 的结果相同（同样的随机数序列，按行优先对应像素）
     if input_filename:
         input_img = cv2.imread(input_filename)
-    input_img_shape = input_img.shape
     output_img = input_img.copy()
-    for i in range(input_img_shape[0]):
-        for j in range(input_img_shape[1]):
-            if np.random.rand() < ratio:
-                output_img[i, j, :] = 255
+    output_img[get_rng(seed).rand(*input_img.shape[:2]) < ratio] = 255
+    if output_file_name:
+        cv2.imwrite(output_file_name, output_img)
+    return output_img
+
+
+def jpeg_att(input_filename=None, input_img=None, output_file_name=None, quality=50):
+    # JPEG 压缩攻击：在内存中编码、解码，不写中间文件
+    if input_filename:
+        input_img = cv2.imread(input_filename)
+    _, buf = cv2.imencode('.jpg', np.ascontiguousarray(input_img), [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    output_img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
@@ -202,24 +229,153 @@ def anti_cut_att(input_filename=None, input_img=None, output_file_name=None, ori
     # origin_shape 分辨率与约定理解的是颠倒的，约定的是列数*行数
     if input_filename:
         input_img = cv2.imread(input_filename)
-    output_img = input_img.copy()
-    output_img_shape = output_img.shape
-    if output_img_shape[0] > origin_shape[0] or output_img_shape[1] > origin_shape[1]:
+    input_img_shape = input_img.shape
+    if input_img_shape[0] > origin_shape[0] or input_img_shape[1] > origin_shape[1]:
         print('裁剪打击后的图片，不可能比原始图片大，检查一下')
         return
 
-    # 还原纵向打击
-    if output_img_shape[0] < origin_shape[0]:
-        output_img = np.concatenate(
-            [output_img, 255 * np.ones((origin_shape[0] - output_img_shape[0], output_img_shape[1], 3))]
-            , axis=0)
-        output_img_shape = output_img.shape
-
-    if output_img_shape[1] < origin_shape[1]:
-        output_img = np.concatenate(
-            [output_img, 255 * np.ones((output_img_shape[0], origin_shape[1] - output_img_shape[1], 3))]
-            , axis=1)
+    # 还原纵向、横向打击：一次分配原尺寸的白图，再把输入放在左上角，保持输入的 dtype
+    output_img = np.full((origin_shape[0], origin_shape[1]) + input_img_shape[2:], 255, dtype=input_img.dtype)
+    output_img[:input_img_shape[0], :input_img_shape[1]] = input_img
 
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
+
+
+class AttackChain:
+    '''
+    在内存中依次施加多个攻击，只处理 uint8 图片，不读写文件
+    每一步的输出写进这一步自己的 buffer，buffer 在多次调用之间复用（尺寸不变时不再分配），
+    剪切只取视图，亮度、遮挡、椒盐直接在上一步的 buffer 上修改
+    chain = AttackChain().crop(loc_r=((0.1, 0.1), (0.9, 0.9))).resize(scale=0.7).jpeg(quality=70)
+    attacked = chain(embed_img)
+    bwm.extract(embed_img=attacked, wm_shape=..., mode='str')
+    返回的图片是 chain 内部 buffer 的视图，下一次调用时会被覆盖，需要保留时自行 copy
+    同一个 chain 不能在多个线程中同时调用
+    '''
+
+    def __init__(self):
+        self.steps = []  # (名称, 类型, func)，类型为 'view'、'new' 或 'inplace'
+        self.buffers = []  # 每一步复用的输出 buffer
+        self.origin_shape = None  # 本次调用输入图片的尺寸，恢复尺寸的步骤用到
+
+    def add(self, name, func, kind='new'):
+        '''
+        :param func: func(img, buffer, rng), returns the attacked image
+            buffer(shape) gives this step's reusable uint8 buffer, rng is a np.random.RandomState or np.random
+        :param kind: 'view' if func returns a view of img, 'inplace' if it modifies img,
+            'new' if it writes into buffer or a new array
+        '''
+        self.steps.append((name, kind, func))
+        self.buffers.append(None)
+        return self
+
+    def buffer(self, i, shape):
+        buf = self.buffers[i]
+        if buf is None or buf.shape != tuple(shape):
+            buf = self.buffers[i] = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    def __call__(self, img, seed=None, inplace=False):
+        '''
+        :param img: uint8 array
+        :param seed: int or None
+            Seed of the random steps (step i uses seed + i), None uses the global np.random state
+        :param inplace: bool
+            Allow in-place steps to modify img when they come before any copying step
+        '''
+        assert img.dtype == np.uint8, 'AttackChain only supports uint8 images'
+        self.origin_shape = img.shape
+        owned = inplace  # 当前的 img 是否可以直接修改
+        for i, (name, kind, func) in enumerate(self.steps):
+            if kind == 'inplace' and not owned:
+                buf = self.buffer(i, img.shape)
+                np.copyto(buf, img)
+                img = buf
+            rng = get_rng(None if seed is None else seed + i)
+            img = func(img, lambda shape, i=i: self.buffer(i, shape), rng)
+            owned = owned or kind != 'view'
+        return img
+
+    def __repr__(self):
+        return 'AttackChain({})'.format(' -> '.join(name for name, _, _ in self.steps))
+
+    def crop(self, loc_r=None, loc=None):
+        # 剪切攻击，与 cut_att3 相同，只取视图
+        def crop(img, buffer, rng):
+            x1, y1, x2, y2 = get_loc(loc_r, loc, img.shape)
+            return img[y1:y2, x1:x2]
+
+        return self.add('crop', crop, kind='view')
+
+    def resize(self, scale=None, out_shape=None):
+        # 缩放攻击：按比例 scale 或缩放到 out_shape=(宽, 高)，两者都为空时缩放回输入图片的原尺寸
+        def resize(img, buffer, rng):
+            h, w = img.shape[:2]
+            if out_shape is not None:
+                dsize = tuple(out_shape)
+            elif scale is not None:
+                dsize = (round(w * scale), round(h * scale))
+            else:
+                dsize = (self.origin_shape[1], self.origin_shape[0])
+            return cv2.resize(img, dsize=dsize, dst=buffer((dsize[1], dsize[0]) + img.shape[2:]))
+
+        return self.add('resize', resize)
+
+    def recover_crop(self, loc_r=None, loc=None, fill=0):
+        # 把剪切（并缩放）后的图片缩放回原图中 loc 的位置，其余部分填 fill，与 recover.recover_crop 相同
+        def recover_crop(img, buffer, rng):
+            x1, y1, x2, y2 = get_loc(loc_r, loc, self.origin_shape)
+            out = buffer(self.origin_shape[:2] + img.shape[2:])
+            out[...] = fill
+            cv2.resize(img, dsize=(x2 - x1, y2 - y1), dst=out[y1:y2, x1:x2])
+            return out
+
+        return self.add('recover_crop', recover_crop)
+
+    def bright(self, ratio=0.8):
+        # 亮度调整攻击，与 bright_att 相同，取整并截断到 [0, 255]
+        def bright(img, buffer, rng):
+            return cv2.convertScaleAbs(img, dst=img, alpha=ratio)
+
+        return self.add('bright', bright, kind='inplace')
+
+    def shelter(self, ratio=0.1, n=3):
+        # 遮挡攻击，与 shelter_att 相同
+        def shelter(img, buffer, rng):
+            h, w = img.shape[:2]
+            for _ in range(n):
+                tmp = rng.rand() * (1 - ratio)
+                start_height, end_height = int(tmp * h), int((tmp + ratio) * h)
+                tmp = rng.rand() * (1 - ratio)
+                start_width, end_width = int(tmp * w), int((tmp + ratio) * w)
+                img[start_height:end_height, start_width:end_width] = 255
+            return img
+
+        return self.add('shelter', shelter, kind='inplace')
+
+    def salt_pepper(self, ratio=0.01):
+        # 椒盐攻击，与 salt_pepper_att 相同
+        def salt_pepper(img, buffer, rng):
+            img[rng.rand(*img.shape[:2]) < ratio] = 255
+            return img
+
+        return self.add('salt_pepper', salt_pepper, kind='inplace')
+
+    def rot(self, angle=45):
+        # 旋转攻击，与 rot_att 相同
+        def rot(img, buffer, rng):
+            rows, cols = img.shape[:2]
+            M = cv2.getRotationMatrix2D(center=(cols / 2, rows / 2), angle=angle, scale=1)
+            return cv2.warpAffine(img, M, (cols, rows), dst=buffer(img.shape))
+
+        return self.add('rot', rot)
+
+    def jpeg(self, quality=50):
+        # JPEG 压缩攻击，与 jpeg_att 相同，解码结果由 cv2.imdecode 分配
+        def jpeg(img, buffer, rng):
+            _, buf = cv2.imencode('.jpg', np.ascontiguousarray(img), [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+            return cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+
+        return self.add('jpeg', jpeg)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 性能测试：在不同尺寸的合成图片上，测试各个 AutoPool 模式、进程数下 embed/extract 的耗时，
+# 以及 estimate_crop_parameters 和 att 中各攻击函数的耗时，结果写成 JSON 或 CSV，便于跨版本对比
+#
+# python -m blind_watermark.bench
+# python -m blind_watermark.bench --sizes 256,1080p --modes vectorization,multiprocessing --processes 1,4 -o bench.csv
+import csv
+import json
+import os
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+import cv2
+import numpy as np
+
+from . import att
+from .blind_watermark import WaterMark
+from .recover import estimate_crop_parameters
+from .version import __version__, bw_notes
+
+# 名称 -> (高, 宽)
+SIZES = {
+    '256': (256, 256),
+    '512': (512, 512),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+    '8k': (4320, 7680),
+}
+MODES = ('common', 'vectorization', 'cached', 'multithreading', 'multiprocessing')
+
+# 逐块处理的 common 模式太慢，默认只在不超过这个像素数的图片上测试
+SLOW_MAX_PIXELS = 1920 * 1080
+# estimate_crop_parameters 在 8k 图片上单核需要约 3 分钟，默认只测到 4k
+RECOVER_MAX_PIXELS = 3840 * 2160
+
+WM_BITS = 256
+
+FIELDS = ('benchmark', 'size', 'height', 'width', 'mode', 'processes', 'fast_mode',
+          'repeat', 'seconds_min', 'seconds_mean', 'megapixels_per_second', 'status')
+
+
+def synthetic_image(height, width, seed=0):
+    # 低分辨率噪声放大后叠加少量细节噪声，接近自然图片的纹理，水印可以正常嵌入和提取
+    rng = np.random.RandomState(seed)
+    base = rng.randint(0, 256, size=(max(height // 16, 2), max(width // 16, 2), 3)).astype(np.uint8)
+    img = cv2.resize(base, dsize=(width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    img += rng.randint(-8, 9, size=img.shape, dtype=np.int16)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def time_call(func, repeat):
+    seconds = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - tic)
+    return min(seconds), sum(seconds) / len(seconds)
+
+
+def make_row(benchmark, size, img, repeat, mode='', processes='', fast_mode='', seconds=None, status='ok'):
+    height, width = img.shape[:2]
+    row = dict(benchmark=benchmark, size=size, height=height, width=width, mode=mode,
+               processes='' if processes is None else processes, fast_mode=fast_mode, repeat=repeat,
+               seconds_min='', seconds_mean='', megapixels_per_second='', status=status)
+    if seconds is not None:
+        row['seconds_min'], row['seconds_mean'] = round(seconds[0], 6), round(seconds[1], 6)
+        row['megapixels_per_second'] = round(height * width / 1e6 / seconds[0], 3)
+    return row
+
+
+def bench_watermark(size, img, mode, processes, repeat, fast_mode=False, no_limit=False):
+    # embed 包含 read_img（颜色空间转换、dwt、分块），extract 从 uint8 图片开始
+    if mode == 'common' and not no_limit and img.shape[0] * img.shape[1] > SLOW_MAX_PIXELS:
+        return [make_row(name, size, img, repeat, mode, processes, fast_mode, status='skipped')
+                for name in ('embed', 'extract')]
+
+    wm_bit = np.random.RandomState(1).randint(0, 2, size=WM_BITS).astype(bool)
+    with WaterMark(mode=mode, processes=processes, fast_mode=fast_mode) as bwm:
+        bwm.read_wm(wm_bit, mode='bit')
+
+        def embed():
+            bwm.read_img(img=img)
+            return bwm.embed()
+
+        embed_img = np.rint(embed()).astype(np.uint8)  # 预热，同时得到提取用的图片
+        embed_seconds = time_call(embed, repeat)
+        extract_seconds = time_call(lambda: bwm.extract(embed_img=embed_img, wm_shape=WM_BITS, mode='bit'), repeat)
+        wm_extract = bwm.extract(embed_img=embed_img, wm_shape=WM_BITS, mode='bit')
+
+    status = 'ok' if np.array_equal(wm_extract > 0.5, wm_bit) else 'wrong watermark'
+    return [make_row('embed', size, img, repeat, mode, processes, fast_mode, embed_seconds, status),
+            make_row('extract', size, img, repeat, mode, processes, fast_mode, extract_seconds, status)]
+
+
+def bench_recover(size, img, repeat, workers, no_limit=False):
+    # 截取原图中间 60% 并缩放 0.8，估计截取位置和缩放比例
+    if not no_limit and img.shape[0] * img.shape[1] > RECOVER_MAX_PIXELS:
+        return [make_row('estimate_crop_parameters[{}]'.format(backend), size, img, repeat, processes=workers,
+                         status='skipped') for backend in ('opencv', 'fft')]
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    x1, y1, x2, y2 = int(w * 0.2), int(h * 0.2), int(w * 0.8), int(h * 0.8)
+    template = cv2.resize(gray[y1:y2, x1:x2], dsize=(round((x2 - x1) * 0.8), round((y2 - y1) * 0.8)))
+
+    rows = []
+    for backend in ('opencv', 'fft'):
+        def estimate():
+            return estimate_crop_parameters(ori_img=gray, tem_img=template, scale=(0.5, 2), search_num=200,
+                                            workers=workers, backend=backend)
+
+        (x1_, y1_, x2_, y2_), _, _, _ = estimate()
+        status = 'ok' if max(abs(x1_ - x1), abs(y1_ - y1), abs(x2_ - x2), abs(y2_ - y2)) <= 0.02 * max(h, w) \
+            else 'wrong location'
+        rows.append(make_row('estimate_crop_parameters[{}]'.format(backend), size, img, repeat,
+                             processes=workers, seconds=time_call(estimate, repeat), status=status))
+    return rows
+
+
+def att_cases(img):
+    h, w = img.shape[:2]
+    return [
+        ('cut_att3', lambda: att.cut_att3(input_img=img, loc_r=((0.1, 0.1), (0.9, 0.9)), scale=0.7)),
+        ('resize_att', lambda: att.resize_att(input_img=img, out_shape=(w // 2, h // 2))),
+        ('bright_att', lambda: att.bright_att(input_img=img, ratio=0.9)),
+        ('shelter_att', lambda: att.shelter_att(input_img=img, ratio=0.1, n=3, seed=0)),
+        ('salt_pepper_att', lambda: att.salt_pepper_att(input_img=img, ratio=0.01, seed=0)),
+        ('rot_att', lambda: att.rot_att(input_img=img, angle=45)),
+        ('jpeg_att', lambda: att.jpeg_att(input_img=img, quality=50)),
+    ]
+
+
+def bench_att(size, img, repeat):
+    return [make_row('att.' + name, size, img, repeat, seconds=time_call(func, repeat))
+            for name, func in att_cases(img)]
+
+
+def run(sizes=tuple(SIZES), modes=MODES, processes=(None,), repeat=3, fast_mode=False,
+        benchmarks=('watermark', 'recover', 'att'), no_limit=False, callback=None):
+    '''
+    :param sizes: names in SIZES, or 'HxW' like '600x800'
+    :param processes: process/thread counts tried in multithreading and multiprocessing mode, None means cpu count
+    :param fast_mode: bool or 'both'
+    :param callback: called with each result row as soon as it is measured
+    :return: list of result rows (dict)
+    '''
+    results = []
+
+    def add(rows):
+        for row in rows:
+            results.append(row)
+            if callback is not None:
+                callback(row)
+
+    fast_modes = (False, True) if fast_mode == 'both' else (bool(fast_mode),)
+    for size in sizes:
+        img = synthetic_image(*parse_size(size))
+        if 'watermark' in benchmarks:
+            for mode in modes:
+                # 只有 multithreading/multiprocessing 模式用到进程数
+                for n in (processes if mode in ('multithreading', 'multiprocessing') else (None,)):
+                    for fast in fast_modes:
+                        add(bench_watermark(size, img, mode, n, repeat, fast_mode=fast, no_limit=no_limit))
+        if 'recover' in benchmarks:
+            for n in processes:
+                add(bench_recover(size, img, repeat, workers=n, no_limit=no_limit))
+        if 'att' in benchmarks:
+            add(bench_att(size, img, repeat))
+    return results
+
+
+def parse_size(size):
+    if size in SIZES:
+        return SIZES[size]
+    height, width = size.lower().split('x')
+    return int(height), int(width)
+
+
+def environment():
+    return dict(version=__version__, python=platform.python_version(), numpy=np.__version__,
+                opencv=cv2.__version__, platform=platform.platform(), cpu_count=os.cpu_count(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def write_results(filename, results):
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(dict(environment=environment(), results=results), f, indent=2)
+
+
+def print_row(row):
+    print('{benchmark:<36} {size:>6} {mode:>16} {processes:>4} {fast_mode!s:>5} {seconds_min:>10} {status}'
+          .format(**row))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    opt_parser = OptionParser(usage='python -m blind_watermark.bench [options]')
+    opt_parser.add_option('--sizes', default=','.join(SIZES),
+                          help='Comma separated image sizes, names in {} or HxW, default all'.format(list(SIZES)))
+    opt_parser.add_option('--modes', default=','.join(MODES), help='Comma separated AutoPool modes, default all')
+    opt_parser.add_option('--processes', default='',
+                          help='Comma separated process counts for multithreading/multiprocessing, '
+                               'default cpu count')
+    opt_parser.add_option('--benchmarks', default='watermark,recover,att',
+                          help='Comma separated subset of watermark,recover,att')
+    opt_parser.add_option('--repeat', type='int', default=3, help='Timing repeats, the minimum is reported')
+    opt_parser.add_option('--fast', dest='fast_mode', default='false', help="fast_mode: 'false', 'true' or 'both'")
+    opt_parser.add_option('--no-limit', dest='no_limit', action='store_true', default=False,
+                          help='Also run common mode above 1080p, '
+                               'and estimate_crop_parameters above 4k')
+    opt_parser.add_option('-o', '--output', help='Write results to a .json or .csv file')
+    opts, _ = opt_parser.parse_args(argv)
+
+    bw_notes.close()
+    fast_mode = {'false': False, 'true': True, 'both': 'both'}[opts.fast_mode.lower()]
+    processes = [int(i) for i in opts.processes.split(',') if i] or [None]
+
+    print(environment())
+    print('{:<36} {:>6} {:>16} {:>4} {:>5} {:>10} {}'.format(
+        'benchmark', 'size', 'mode', 'proc', 'fast', 'seconds', 'status'))
+    results = run(sizes=opts.sizes.split(','), modes=opts.modes.split(','), processes=processes,
+                  repeat=opts.repeat, fast_mode=fast_mode, benchmarks=opts.benchmarks.split(','),
+                  no_limit=opts.no_limit, callback=print_row)
+    if opts.output:
+        write_results(opts.output, results)
+        print('Results written to', opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,33 +2,103 @@
 # coding=utf-8
 # @Time    : 2020/8/13
 # @Author  : github.com/guofei9987
+import os
 import warnings
+from contextlib import contextmanager
+from multiprocessing.dummy import Pool as ThreadPool
 
 import numpy as np
 import cv2
 
-from .bwm_core import WaterMarkCore
+from .bwm_core import WaterMarkCore, one_dim_kmeans, kmeans_threshold
+from .header import encode_header, decode_header, payload_capacity
+from . import ecc as ecc_code
+from .stage_stats import NULL_STATS, as_stats
 from .version import bw_notes
 
 
 class WaterMark:
-    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None):
+    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None,
+                 chunksize=None, strip_height=None, channels='YUV', fast_mode=False, header=False,
+                 ecc=False):
+        '''
+        :param strip_height: int or None
+            If set, embed the image in horizontal strips of about strip_height pixels,
+            so peak memory depends on the strip size instead of the image size. Extraction is unchanged
+        :param channels: string or sequence of int
+            YUV channels that carry the watermark, e.g. 'Y' or (0,) for the luminance only, 'YU' for Y and U.
+            Fewer channels are proportionally faster but less robust. Extraction must use the same channels
+        :param fast_mode: bool
+            Skip the block shuffle and quantize only the first singular value. About 1.5x faster, the output
+            has higher PSNR, but is less robust and the block positions no longer depend on password_img.
+            Images embedded in fast mode must be extracted with fast_mode=True
+            (with header=True this is detected automatically)
+        :param header: bool
+            Also embed a small header (watermark type and shape) into a fixed 1/16 of the blocks,
+            so extract works without wm_shape. Images embedded with a header must be extracted with header=True
+        :param ecc: bool
+            Protect 'str' and 'bit' watermarks with a rate 1/2 convolutional code, decoded by soft-decision Viterbi.
+            The embedded watermark is about twice as long, but survives much stronger attacks, or allows smaller
+            d1/d2 (less distortion) or fewer channels. wm_shape for extract is the embedded length (len(bwm.wm_bit)).
+            Images embedded with ecc must be extracted with ecc=True (with header=True this is detected automatically)
+        '''
         bw_notes.print_notes()
 
-        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes)
+        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes, chunksize=chunksize,
+                                      strip_height=strip_height, channels=channels)
+        self.bwm_core.fast_mode = fast_mode
+        self.bwm_core.header = header
 
         self.password_wm = password_wm
+        self.ecc = ecc
 
         self.wm_bit = None
         self.wm_size = 0
+        self.payload_bit = None  # 纠错编码、加密之前的水印
+        self.last_stats = None  # 最近一次传了 stats 的调用所用的 StageStats
+        self.last_header = None  # 最近一次 extract 从自描述头解出的 (wm_shape, mode, ecc)
+
+    def close(self):
+        '''
+        Does not free any worker: in 'multithreading'/'multiprocessing' mode the worker pool is shared by all
+        WaterMark instances of the process and stays alive for the next one, also after `with WaterMark(...)`.
+        Call blind_watermark.close_pools() to stop the workers; they are also stopped at interpreter exit
+        '''
+        self.bwm_core.pool.close()
 
-    def read_img(self, filename=None, img=None):
-        if img is None:
-            # 从文件读入图片
-            img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
-            assert img is not None, "image file '{filename}' not read".format(filename=filename)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def use_stats(self, stats):
+        # 本次调用期间让 bwm_core 按阶段记录耗时，stats 为 None 时不记录
+        stats = as_stats(stats)
+        if stats is not NULL_STATS:
+            self.last_stats = stats
+        self.bwm_core.stats = stats
+        try:
+            yield stats
+        finally:
+            self.bwm_core.stats = NULL_STATS
+
+    def read_img(self, filename=None, img=None, stats=None):
+        '''
+        :param img: array or None
+            The image as an array. A numpy.memmap (see blind_watermark.mmap_io) is only read strip by strip
+            when strip_height is set
+        :param stats: same as embed
+        '''
+        with self.use_stats(stats) as stats:
+            if img is None:
+                # 从文件读入图片
+                with stats.stage('imread'):
+                    img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
+                assert img is not None, "image file '{filename}' not read".format(filename=filename)
 
-        self.bwm_core.read_img_arr(img=img)
+            self.bwm_core.read_img_embed(img=img)
         return img
 
     def read_wm(self, wm_content, mode='img'):
@@ -39,6 +109,7 @@ class WaterMark:
 
             # 读入图片格式的水印，并转为一维 bit 格式，抛弃灰度级别
             self.wm_bit = wm.flatten() > 128
+            wm_shape = wm.shape
 
         elif mode == 'str':
             byte = bin(int(wm_content.encode('utf-8').hex(), base=16))[2:]
@@ -46,70 +117,377 @@ class WaterMark:
         else:
             self.wm_bit = np.array(wm_content)
 
+        self.payload_bit = np.asarray(self.wm_bit, dtype=bool).copy()
+
+        # 纠错编码，在加密之前，打乱顺序同时起到交织的作用
+        ecc = self.ecc and mode != 'img'
+        if ecc:
+            self.wm_bit = ecc_code.encode(self.wm_bit)
+
         self.wm_size = self.wm_bit.size
+        if mode != 'img':
+            wm_shape = self.wm_size
 
         # 水印加密:
         np.random.RandomState(self.password_wm).shuffle(self.wm_bit)
 
-        self.bwm_core.read_wm(self.wm_bit)
+        header_bit = encode_header(mode, wm_shape, self.password_wm, ecc=ecc) if self.bwm_core.header else None
+        self.bwm_core.read_wm(self.wm_bit, header_bit=header_bit)
 
-    def embed(self, filename=None, compression_ratio=None):
+    def embed(self, filename=None, compression_ratio=None, out=None, stats=None):
         '''
         :param filename: string
             Save the image file as filename
         :param compression_ratio: int or None
             If compression_ratio = None, do not compression,
             If compression_ratio is integer between 0 and 100, the smaller, the output file is smaller.
-        :return:
-        '''
-        embed_img = self.bwm_core.embed()
-        if filename is not None:
-            if compression_ratio is None:
-                cv2.imwrite(filename=filename, img=embed_img)
-            elif filename.endswith('.jpg'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
-            elif filename.endswith('.png'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
-            else:
-                cv2.imwrite(filename=filename, img=embed_img)
+        :param out: uint8 array or None
+            Pre-allocated output with the same shape as the image, e.g. a numpy.memmap from
+            blind_watermark.mmap_io.create_tiff / create_raw. The result is written into it and it is returned.
+            Together with strip_height, a memory-mapped image can be embedded without loading it into memory
+        :param stats: None, True, a blind_watermark.stage_stats.StageStats, or a callback
+            Record the wall time (and allocated bytes if StageStats(trace_memory=True)) of each stage:
+            key_material, block_map[Y/U/V], idwt2, color_convert, clip_convert, imwrite.
+            A callback is called as callback(stage, seconds, peak_bytes) at the end of every stage,
+            True creates a new StageStats. The StageStats used is also kept in self.last_stats.
+            Pass the same StageStats to read_img to include imread, color_convert, dwt2 and block_split
+        :return: array
+            The embedded image. Its dtype depends on how it was produced:
+            float32 clipped to [0, 255] but not rounded (as in earlier versions) by default;
+            uint8 if strip_height is set (each strip is rounded as it is written, so no float copy of the
+            whole image exists), if out is given (out itself is returned), or if the image has an alpha channel.
+            Round with np.rint(...).astype(np.uint8) to get the pixels that are saved to filename
+        '''
+        with self.use_stats(stats) as stats:
+            embed_img = self.bwm_core.embed(out=out)
+            if isinstance(out, np.memmap):
+                with stats.stage('imwrite'):
+                    out.flush()
+            if filename is not None:
+                with stats.stage('imwrite'):
+                    write_img(filename, embed_img, compression_ratio)
         return embed_img
 
+    def embed_many(self, inputs, outputs, compression_ratio=None, workers=None):
+        '''
+        批量嵌入，需要先 read_wm，水印只读入、加密一次，所有图片复用
+        :param inputs: string or iterable
+            Directory of images, or an iterable of image filenames
+        :param outputs: string or iterable
+            Output directory, or an iterable of output filenames matching inputs one by one
+        :param compression_ratio: int or None
+            Same as embed
+        :param workers: int or None
+            Number of threads that read, embed and write images concurrently, None means cpu count
+        :return: generator
+            Yields (input_filename, output_filename, status) as soon as each image is done,
+            status is 'ok', or the error message if that image failed
+        '''
+        assert self.wm_bit is not None, 'read_wm before embed_many'
+        inputs, outputs = list_io_files(inputs, outputs)
+
+        def embed_one(filenames):
+            filename, out_filename = filenames
+            try:
+                img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
+                assert img is not None, "image file '{filename}' not read".format(filename=filename)
+                # 每张图片一个独立的 core，共用 worker 池和密钥缓存
+                bwm_core = self.bwm_core.clone()
+                bwm_core.read_wm(self.wm_bit, header_bit=self.bwm_core.header_bit)
+                bwm_core.read_img_embed(img=img)
+                write_img(out_filename, bwm_core.embed(), compression_ratio)
+                return filename, out_filename, 'ok'
+            except Exception as e:
+                return filename, out_filename, str(e) or repr(e)
+
+        self.bwm_core.pool.start()  # 在单线程时创建多进程池，见 AutoPool.start
+        return imap_unordered(embed_one, zip(inputs, outputs), workers)
+
+    def decode_wm(self, wm_avg, wm_shape, mode, ecc=None):
+        '''
+        每个 bit 的平均值 -> 解密、（纠错译码或 kmeans 二值化）、转化为指定格式
+        :param ecc: None means self.ecc
+        '''
+        ecc = self.ecc if ecc is None else ecc
+        if ecc and mode in ('str', 'bit'):
+            # 软判决译码直接使用平均值，不先二值化。剪切、遮挡后填充的区域会把平均值整体拉向 0 或 1，
+            # 先按 kmeans 的两个中心线性映射到 0 和 1，与 kmeans 二值化的阈值一致
+            _, center = kmeans_threshold(wm_avg)
+            if center[1] > center[0]:
+                wm_avg = np.clip((wm_avg - center[0]) / (center[1] - center[0]), 0, 1)
+            wm = ecc_code.decode(self.extract_decrypt(wm_avg=wm_avg))
+            return convert_wm(wm, wm.size, mode)
+        if mode in ('str', 'bit'):
+            wm_avg = one_dim_kmeans(wm_avg)
+        return convert_wm(self.extract_decrypt(wm_avg=wm_avg), wm_shape, mode)
+
     def extract_decrypt(self, wm_avg):
-        wm_index = np.arange(self.wm_size)
+        wm_index = np.arange(wm_avg.size)
         np.random.RandomState(self.password_wm).shuffle(wm_index)
         wm_avg[wm_index] = wm_avg.copy()
         return wm_avg
 
-    def extract(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img'):
-        assert wm_shape is not None, 'wm_shape needed'
+    def extract(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img',
+                return_confidence=False, early_exit=None, stats=None):
+        '''
+        :param return_confidence: bool
+            If True, return (wm, confidence, bit_confidence), confidence is the mean of bit_confidence,
+            bit_confidence is the confidence of each bit in [0, 1), in the same order as wm
+            (with ecc, of each embedded bit before decoding)
+        :param early_exit: float or None
+            If not None (e.g. 0.99), extract progressively and stop once every bit's confidence reaches it,
+            so only part of the blocks are processed
+        :param wm_shape: watermark shape, can be None if the image was embedded with header=True,
+            then wm_shape, mode and ecc are read from the header (and kept in self.last_header),
+            and fast_mode is detected. The mode argument is ignored in that case
+        :param stats: same as embed, stages: imread, color_convert, dwt2, block_split, key_material, header,
+            block_map, average, decrypt (including ecc decoding), imwrite
+        '''
+        assert wm_shape is not None or self.bwm_core.header, 'wm_shape needed'
 
-        if filename is not None:
-            embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
-            assert embed_img is not None, "{filename} not read".format(filename=filename)
+        with self.use_stats(stats) as stats:
+            if filename is not None:
+                with stats.stage('imread'):
+                    embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
+                assert embed_img is not None, "{filename} not read".format(filename=filename)
 
-        self.wm_size = np.array(wm_shape).prod()
+            ecc, fast_mode = None, self.bwm_core.fast_mode
+            try:
+                if wm_shape is None:
+                    wm_shape, mode, ecc = self.last_header = self.detect_header(self.bwm_core, embed_img)
+                    embed_img = None  # 复用已经读入的图片
+                self.wm_size = np.array(wm_shape).prod()
 
-        if mode in ('str', 'bit'):
-            wm_avg = self.bwm_core.extract_with_kmeans(img=embed_img, wm_shape=wm_shape)
-        else:
-            wm_avg = self.bwm_core.extract(img=embed_img, wm_shape=wm_shape)
+                wm_avg, bit_confidence = self.bwm_core.extract_with_confidence(img=embed_img, wm_shape=wm_shape,
+                                                                               early_exit=early_exit)
+            finally:
+                # 自描述头检测出的模式只用于这一次提取
+                self.bwm_core.fast_mode = fast_mode
 
-        # 解密：
-        wm = self.extract_decrypt(wm_avg=wm_avg)
+            # 解密、纠错，转化为指定格式：
+            with stats.stage('decrypt'):
+                wm = self.decode_wm(wm_avg, wm_shape, mode, ecc=ecc)
+                bit_confidence = self.extract_decrypt(wm_avg=bit_confidence)
+            if mode == 'img' and out_wm_name is not None:
+                with stats.stage('imwrite'):
+                    cv2.imwrite(out_wm_name, wm)
 
-        # 转化为指定格式：
-        if mode == 'img':
-            wm = 255 * wm.reshape(wm_shape[0], wm_shape[1])
-            cv2.imwrite(out_wm_name, wm)
-        # elif mode == 'str':
-        #     byte = ''.join(str((i >= 0.5) * 1) for i in wm)
-        #     wm = bytes.fromhex(hex(int(byte, base=2))[2:]).decode('utf-8', errors='replace')
-        elif mode == 'str':
-            byte = ''.join(str((i >= 0.5) * 1) for i in wm)
-            hex_str = hex(int(byte, base=2))[2:]
-            # 确保十六进制字符串为偶数长度
-            if len(hex_str) % 2:
-                hex_str = '0' + hex_str
-            wm = bytes.fromhex(hex_str).decode('utf-8', errors='replace')
+        if return_confidence:
+            return wm, float(bit_confidence.mean()), bit_confidence
+        return wm
+
+    def extract_raw(self, filename=None, embed_img=None, stats=None):
+        '''
+        只读入、变换图片并提取每个分块的 bit 一次，不需要 wm_shape
+        返回的 RawExtraction 可以按任意多个候选 wm_shape 解码、打分，每个候选只需要求平均和解密
+        :param stats: same as embed, stages: imread, color_convert, dwt2, block_split, key_material, block_map
+        :return: RawExtraction
+        '''
+        with self.use_stats(stats) as stats:
+            if filename is not None:
+                with stats.stage('imread'):
+                    embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
+                assert embed_img is not None, "{filename} not read".format(filename=filename)
+            self.bwm_core.wm_size = 0
+            wm_block_bit = self.bwm_core.extract_raw(img=embed_img)
+        return RawExtraction(self, wm_block_bit)
 
+    def detect_header(self, bwm_core, embed_img):
+        # 只处理放头部的分块，解出水印的形状、类型和是否纠错编码，读入的图片留在 bwm_core 中继续提取水印
+        # 头部先用 bwm_core 当前的算子解码，CRC 不通过时再用另一种（快速/普通模式）算子解码，
+        # 通过的那种就是嵌入时的模式，bwm_core.fast_mode 设为该模式
+        try:
+            return decode_header(bwm_core.extract_header(img=embed_img), self.password_wm)
+        except ValueError:
+            bwm_core.fast_mode = not bwm_core.fast_mode
+            try:
+                return decode_header(bwm_core.extract_header(img=None), self.password_wm)
+            except ValueError:
+                bwm_core.fast_mode = not bwm_core.fast_mode
+                raise
+
+    def extract_many(self, inputs, wm_shape, mode='img', workers=None, early_exit=None):
+        '''
+        批量提取，多张图片并发解码、提取，同尺寸的图片复用缓存的分块打乱顺序
+        :param inputs: string or iterable
+            Directory of images, or an iterable of image filenames
+        :param wm_shape: same as extract, None to read wm_shape and mode from the header of each image
+        :param mode: same as extract, in 'img' mode the watermark array is returned instead of written to a file
+        :param workers: int or None
+            Number of images extracted concurrently, None means cpu count
+        :param early_exit: same as extract
+        :return: generator
+            Yields (filename, wm, confidence) as soon as each image is done,
+            confidence in [0, 1) is the mean confidence of all bits, see extract.
+            If an image failed, wm is None and confidence is 0
+        '''
+        assert wm_shape is not None or self.bwm_core.header, 'wm_shape needed'
+        inputs = list_images(inputs)
+
+        def extract_one(filename):
+            try:
+                embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
+                assert embed_img is not None, "{filename} not read".format(filename=filename)
+                bwm_core = self.bwm_core.clone()
+                img_wm_shape, img_mode, img_ecc = wm_shape, mode, None
+                if wm_shape is None:
+                    img_wm_shape, img_mode, img_ecc = self.detect_header(bwm_core, embed_img)
+                    embed_img = None
+                wm_avg, bit_confidence = bwm_core.extract_with_confidence(img=embed_img, wm_shape=img_wm_shape,
+                                                                          early_exit=early_exit)
+                confidence = float(bit_confidence.mean())
+                wm = self.decode_wm(wm_avg, img_wm_shape, img_mode, ecc=img_ecc)
+                return filename, wm, confidence
+            except Exception as e:
+                warnings.warn('extract failed: {filename}, {e!r}'.format(filename=filename, e=e))
+                return filename, None, 0.0
+
+        self.bwm_core.pool.start()  # 在单线程时创建多进程池，见 AutoPool.start
+        return imap_unordered(extract_one, inputs, workers)
+
+
+class RawExtraction:
+    '''
+    WaterMark.extract_raw 的结果：每个分块提取的 bit，与水印长度无关
+    同一张图片的水印长度未知时，用它对多个候选长度解码、打分，而不是对每个候选重新 extract
+    '''
+
+    def __init__(self, bwm, wm_block_bit):
+        self.bwm = bwm
+        self.wm_block_bit = wm_block_bit  # (channel 数, 分块数)
+        block_num = wm_block_bit.shape[1]
+        # 水印长度的上限（不含）
+        self.max_size = payload_capacity(block_num) if bwm.bwm_core.header else block_num
+
+    def check_shape(self, wm_shape):
+        wm_size = int(np.prod(wm_shape))
+        assert 0 < wm_size < self.max_size, 'wm_shape {} out of range, max size {}'.format(wm_shape, self.max_size)
+        return wm_size
+
+    def decode(self, wm_shape, mode='img', return_confidence=False):
+        '''
+        按 wm_shape 求平均、解密，与 WaterMark.extract 的结果相同，img 模式返回数组而不写文件
+        :param return_confidence: same as WaterMark.extract
+        '''
+        wm_size = self.check_shape(wm_shape)
+        wm = self.bwm.decode_wm(self.bwm.bwm_core.extract_avg(self.wm_block_bit, wm_size), wm_shape, mode)
+        if return_confidence:
+            bit_confidence = self.bwm.extract_decrypt(
+                wm_avg=self.bwm.bwm_core.extract_bit_confidence(self.wm_block_bit, wm_size))
+            return wm, float(bit_confidence.mean()), bit_confidence
         return wm
+
+    def score(self, wm_shape):
+        '''
+        候选长度的可信程度：按 bit 分组后组间差异能解释的方差比例（调整后的 R^2），约在 [0, 1] 之间
+        长度正确时同一 bit 的各个副本一致，组内方差很小，得分接近 1；长度错误时每组都是不相关的 bit 的混合，得分接近 0
+        真实长度的整数倍同样一致，得分只略低（组数更多，自由度更少）
+        '''
+        wm_size = self.check_shape(wm_shape)
+        copies = self.bwm.bwm_core.reshape_by_bit(self.wm_block_bit, wm_size)
+        n = np.count_nonzero(~np.isnan(copies))
+        ss_total = np.nansum((copies - np.nanmean(copies)) ** 2)
+        if ss_total == 0 or n <= wm_size:
+            return 0.0
+        ss_within = np.nansum((copies - np.nanmean(copies, axis=(0, 1))) ** 2)
+        return float(1 - ss_within / (n - wm_size) / (ss_total / (n - 1)))
+
+    def z_score(self, wm_shape, score=None):
+        '''
+        得分是没有水印时（各组只是噪声）得分标准差 sqrt(2(k-1))/(n-1) 的多少倍，没有水印时近似服从标准正态分布
+        候选长度越长，每个 bit 的副本越少，噪声的得分越大，因此判断有没有水印用它而不是 score
+        '''
+        wm_size = self.check_shape(wm_shape)
+        n = np.count_nonzero(~np.isnan(self.bwm.bwm_core.reshape_by_bit(self.wm_block_bit, wm_size)))
+        score = self.score(wm_shape) if score is None else score
+        return float(score * (n - 1) / np.sqrt(2 * max(wm_size - 1, 1)))
+
+    def rank(self, candidates):
+        '''
+        :param candidates: iterable of wm_shape
+        :return: list of (wm_shape, score), the highest score first
+        '''
+        scores = [(wm_shape, self.score(wm_shape)) for wm_shape in candidates]
+        return sorted(scores, key=lambda item: -item[1])
+
+    def best(self, candidates, tol=0.05, min_z=8.0):
+        '''
+        得分最高的候选；得分与最高分相差不超过 tol * |最高分| 的候选中取长度最小的，避免选中真实长度的整数倍
+        受攻击后得分整体变低，所以 tol 是相对值
+        :param min_z: float
+            The chosen candidate must have z_score above min_z, otherwise no candidate is plausible
+            (the image has no watermark, or none of the candidates is the right length).
+            Without a watermark the highest z_score of a few thousand candidates is about 4
+        :return: (wm_shape, score), or (None, highest score) if no candidate is plausible
+        '''
+        ranked = self.rank(candidates)
+        assert ranked, 'no candidates'
+        top_score = ranked[0][1]
+        wm_shape, score = min((item for item in ranked if item[1] >= top_score - tol * abs(top_score)),
+                              key=lambda item: np.prod(item[0]))
+        if self.z_score(wm_shape, score) <= min_z:
+            return None, top_score
+        return wm_shape, score
+
+
+def convert_wm(wm, wm_shape, mode):
+    # 解密后的水印转化为指定格式
+    if mode == 'img':
+        wm = 255 * wm.reshape(wm_shape[0], wm_shape[1])
+    # elif mode == 'str':
+    #     byte = ''.join(str((i >= 0.5) * 1) for i in wm)
+    #     wm = bytes.fromhex(hex(int(byte, base=2))[2:]).decode('utf-8', errors='replace')
+    elif mode == 'str':
+        byte = ''.join(str((i >= 0.5) * 1) for i in wm)
+        hex_str = hex(int(byte, base=2))[2:]
+        # 确保十六进制字符串为偶数长度
+        if len(hex_str) % 2:
+            hex_str = '0' + hex_str
+        wm = bytes.fromhex(hex_str).decode('utf-8', errors='replace')
+    return wm
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def write_img(filename, img, compression_ratio=None):
+    # 去掉白边后的图片、通道倒序的 memmap 等视图不一定连续
+    img = np.ascontiguousarray(img)
+    if compression_ratio is None:
+        cv2.imwrite(filename=filename, img=img)
+    elif filename.endswith('.jpg'):
+        cv2.imwrite(filename=filename, img=img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
+    elif filename.endswith('.png'):
+        cv2.imwrite(filename=filename, img=img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
+    else:
+        cv2.imwrite(filename=filename, img=img)
+
+
+def imap_unordered(func, iterable, workers=None):
+    # 独立的线程池：读图、处理、写图在不同图片之间重叠，cv2 与 numpy 的计算都会释放 GIL
+    # 与分块用的共享池分开，避免在池内的任务里再向同一个池提交任务而死锁
+    pool = ThreadPool(processes=workers)
+    try:
+        for result in pool.imap_unordered(func, iterable):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def list_images(inputs):
+    # inputs 是目录时，列出其中的图片文件，否则当作文件名的可迭代对象
+    if isinstance(inputs, str) and os.path.isdir(inputs):
+        return [os.path.join(inputs, name) for name in sorted(os.listdir(inputs))
+                if name.lower().endswith(IMG_EXTENSIONS)]
+    return list(inputs)
+
+
+def list_io_files(inputs, outputs):
+    inputs = list_images(inputs)
+    if isinstance(outputs, str):
+        os.makedirs(outputs, exist_ok=True)
+        outputs = [os.path.join(outputs, os.path.basename(filename)) for filename in inputs]
+    else:
+        outputs = list(outputs)
+    assert len(inputs) == len(outputs), 'inputs and outputs should have the same length'
+    return inputs, outputs
@@ -4,38 +4,105 @@
 # @Author  : github.com/guofei9987
 import numpy as np
 from numpy.linalg import svd
-import copy
+import functools
 import cv2
 from cv2 import dct, idct
 from pywt import dwt2, idwt2
 from .pool import AutoPool
+from .block_batch import add_wm_batch, get_wm_batch
+from .key_cache import key_cache, make_key_material
+from .shared_blocks import shared_memory, embed_shared, extract_shared
+from .header import HEADER_BITS, bit_index, header_blocks, payload_mask, payload_capacity
+from .stage_stats import NULL_STATS
+
+
+# 转换颜色空间时每段的行数，只有这一段会有 float32 的临时副本
+CONVERT_ROWS = 512
+CHANNEL_NAMES = 'YUV'
 
 
 class WaterMarkCore:
-    def __init__(self, password_img=1, mode='common', processes=None):
+    def __init__(self, password_img=1, mode='common', processes=None, chunksize=None, strip_height=None,
+                 channels='YUV'):
         self.block_shape = np.array([4, 4])
         self.password_img = password_img
         self.d1, self.d2 = 36, 20  # d1/d2 越大鲁棒性越强,但输出图片的失真越大
 
         # init data
-        self.img, self.img_YUV = None, None  # self.img 是原图，self.img_YUV 对像素做了加白偶数化
-        self.ca, self.hvd, = [np.array([])] * 3, [np.array([])] * 3  # 每个通道 dct 的结果
+        self.img = None  # self.img 是原图
+        # 嵌入/提取水印的 YUV 通道，例如 (0,) 只用 Y 通道，其余通道原样保留
+        self.channels = parse_channels(channels)
+        self.ca_buf = np.array([])  # 所选通道 dwt 低频系数共用的 (通道数, h, w) buffer，分块都是它上面的视图
+        self.ca, self.hvd, = [np.array([])] * 3, [np.array([])] * 3  # 每个通道 dct 的结果，self.ca[c] 是 self.ca_buf 的一层
         self.ca_block = [np.array([])] * 3  # 每个 channel 存一个四维 array，代表四维分块后的结果
-        self.ca_part = [np.array([])] * 3  # 四维分块后，有时因不整除而少一部分，self.ca_part 是少这一部分的 self.ca
+        self.ca_block_all = np.array([])  # 五维 (通道数, 行数, 列数, 块高, 块宽)，所选 channel 的分块
+        self.YUV_rest = [None] * 3  # 不嵌入水印的通道，embed 时原样放回
 
         self.wm_size, self.block_num = 0, 0  # 水印的长度，原图片可插入信息的个数
-        self.pool = AutoPool(mode=mode, processes=processes)
+        self.pool = AutoPool(mode=mode, processes=processes, chunksize=chunksize)
 
         self.fast_mode = False
+        self.header = False  # 是否在固定的分块中嵌入自描述头，见 header.py
+        self.header_bit = None
+        self.use_key_cache = mode == 'cached'  # 是否从 key_cache 中取分块打乱顺序
         self.alpha = None  # 用于处理透明图
 
-    def init_block_index(self):
+        # 不为空时按水平条带嵌入，每条高 strip_height 像素（向下取整到 8 的倍数），峰值内存只与条带大小有关
+        self.strip_height = strip_height
+
+        self.stats = NULL_STATS  # 分阶段耗时统计，见 stage_stats.StageStats
+
+    def clone(self):
+        # 复制参数但不复制图片数据，批量处理时每张图片用一个独立的 core
+        bwm_core = WaterMarkCore(password_img=self.password_img, mode=self.pool.mode,
+                                 processes=self.pool.processes, chunksize=self.pool.chunksize,
+                                 strip_height=self.strip_height, channels=self.channels)
+        bwm_core.d1, bwm_core.d2, bwm_core.fast_mode = self.d1, self.d2, self.fast_mode
+        bwm_core.header = self.header
+        # 批量处理的图片往往尺寸相同，总是复用缓存的分块打乱顺序
+        bwm_core.use_key_cache = True
+        return bwm_core
+
+    def init_block_num(self):
         self.block_num = self.ca_block_shape[0] * self.ca_block_shape[1]
-        assert self.wm_size < self.block_num, IndexError(
-            '最多可嵌入{}kb信息，多于水印的{}kb信息，溢出'.format(self.block_num / 1000, self.wm_size / 1000))
+        capacity = payload_capacity(self.block_num) if self.header else self.block_num
+        assert self.wm_size < capacity, IndexError(
+            '最多可嵌入{}kb信息，多于水印的{}kb信息，溢出'.format(capacity / 1000, self.wm_size / 1000))
+        assert not self.header or len(header_blocks(self.block_num)) >= HEADER_BITS, IndexError(
+            '图片太小，放不下自描述头')
         # self.part_shape 是取整后的ca二维大小,用于嵌入时忽略右边和下面对不齐的细条部分。
         self.part_shape = self.ca_block_shape[:2] * self.block_shape
-        self.block_index = [(i, j) for i in range(self.ca_block_shape[0]) for j in range(self.ca_block_shape[1])]
+
+    def init_block_index(self):
+        self.init_block_num()
+        # 分块打乱顺序 idx_shuffle 和分块索引 block_index 只取决于密码和图片尺寸，cached 模式或批量处理时复用
+        with self.stats.stage('key_material'):
+            if self.use_key_cache:
+                self.idx_shuffle, self.block_index = key_cache.get(self.password_img, self.ca_block_shape)
+            else:
+                self.idx_shuffle, self.block_index = make_key_material(self.password_img, self.ca_block_shape)
+
+    def init_img_shape(self, img_shape):
+        self.img_shape = tuple(img_shape[:2])
+        self.ca_shape = [(i + 1) // 2 for i in self.img_shape]
+        self.ca_block_shape = (self.ca_shape[0] // self.block_shape[0], self.ca_shape[1] // self.block_shape[1],
+                               self.block_shape[0], self.block_shape[1])
+
+    def read_img_strips(self, img):
+        # 分条嵌入时只记录原图，类型转换、YUV 化和 dwt 都在 embed_strips 中逐条进行
+        self.alpha = None
+        if img.shape[2] == 4:
+            if img[:, :, 3].min() < 255:
+                self.alpha = img[:, :, 3]
+        self.img = img
+        self.init_img_shape(img.shape)
+
+    def read_img_embed(self, img):
+        # 读入待嵌入的图片，分条模式下推迟到 embed_strips 中逐条转换
+        if self.strip_height:
+            self.read_img_strips(img=img)
+        else:
+            self.read_img_arr(img=img)
 
     def read_img_arr(self, img):
         # 处理透明图
@@ -46,29 +113,54 @@ class WaterMarkCore:
                 img = img[:, :, :3]
 
         # 读入图片->YUV化->加白边使像素变偶数->四维分块
-        self.img = img.astype(np.float32)
-        self.img_shape = self.img.shape[:2]
+        self.img = img
+        self.init_img_shape(img.shape)
 
         # 如果不是偶数，那么补上白边，Y（明亮度）UV（颜色）
-        self.img_YUV = cv2.copyMakeBorder(cv2.cvtColor(self.img, cv2.COLOR_BGR2YUV),
-                                          0, self.img.shape[0] % 2, 0, self.img.shape[1] % 2,
-                                          cv2.BORDER_CONSTANT, value=(0, 0, 0))
-
-        self.ca_shape = [(i + 1) // 2 for i in self.img_shape]
-
-        self.ca_block_shape = (self.ca_shape[0] // self.block_shape[0], self.ca_shape[1] // self.block_shape[1],
-                               self.block_shape[0], self.block_shape[1])
-        strides = 4 * np.array([self.ca_shape[1] * self.block_shape[0], self.block_shape[1], self.ca_shape[1], 1])
-
-        for channel in range(3):
-            self.ca[channel], self.hvd[channel] = dwt2(self.img_YUV[:, :, channel], 'haar')
-            # 转为4维度
-            self.ca_block[channel] = np.lib.stride_tricks.as_strided(self.ca[channel].astype(np.float32),
-                                                                     self.ca_block_shape, strides)
-
-    def read_wm(self, wm_bit):
+        # 按行分段转 float32 并直接写进补好边的 buffer，不产生整图的 float32 副本
+        with self.stats.stage('color_convert'):
+            img_YUV = np.zeros((self.ca_shape[0] * 2, self.ca_shape[1] * 2, 3), dtype=np.float32)
+            for y1 in range(0, self.img_shape[0], CONVERT_ROWS):
+                y2 = min(y1 + CONVERT_ROWS, self.img_shape[0])
+                cv2.cvtColor(img[y1:y2].astype(np.float32), cv2.COLOR_BGR2YUV,
+                             dst=img_YUV[y1:y2, :self.img_shape[1]])
+
+        with self.stats.stage('dwt2'):
+            self.ca_buf = np.empty((len(self.channels),) + tuple(self.ca_shape), dtype=np.float32)
+            for channel in range(3):
+                if channel in self.channels:
+                    self.YUV_rest[channel] = None
+                    idx = self.channels.index(channel)
+                    self.ca_buf[idx], self.hvd[channel] = dwt2(img_YUV[:, :, channel], 'haar')
+                    self.ca[channel] = self.ca_buf[idx]
+                else:
+                    self.YUV_rest[channel] = img_YUV[:, :, channel].copy()
+            del img_YUV
+
+        # 转为4维度：直接在 ca_buf 上取视图，分块上的修改就是对 ca 的修改
+        with self.stats.stage('block_split'):
+            stride_c, stride_h, stride_w = self.ca_buf.strides
+            self.ca_block_all = np.lib.stride_tricks.as_strided(
+                self.ca_buf, (len(self.channels),) + tuple(self.ca_block_shape),
+                (stride_c, stride_h * self.block_shape[0], stride_w * self.block_shape[1], stride_h, stride_w))
+            for idx, channel in enumerate(self.channels):
+                self.ca_block[channel] = self.ca_block_all[idx]
+
+    def block_range(self, start, end):
+        # 第 start 到 end 个分块在四维分块中的 (行, 列) 索引
+        return np.divmod(np.arange(start, end), self.ca_block_shape[1])
+
+    def read_wm(self, wm_bit, header_bit=None):
         self.wm_bit = wm_bit
         self.wm_size = wm_bit.size
+        assert not self.header or header_bit is not None, 'header_bit needed'
+        self.header_bit = header_bit
+        # 嵌入序列：不带头部时就是水印，带头部时是头部再接水印，见 header.bit_index
+        self.embed_bit = np.concatenate([header_bit, wm_bit]) if self.header else wm_bit
+
+    def block_bits(self, idx):
+        # 序号为 idx 的分块要嵌入的 bit
+        return self.embed_bit[bit_index(idx, self.wm_size, self.header)]
 
     def block_add_wm(self, arg):
         if self.fast_mode:
@@ -78,64 +170,166 @@ class WaterMarkCore:
 
     def block_add_wm_slow(self, arg):
         block, shuffler, i = arg
-        # dct->(flatten->加密->逆flatten)->svd->打水印->逆svd->(flatten->解密->逆flatten)->逆dct
-        wm_1 = self.wm_bit[i % self.wm_size]
-        block_dct = dct(block)
-
-        # 加密（打乱顺序）
-        block_dct_shuffled = block_dct.flatten()[shuffler].reshape(self.block_shape)
-        u, s, v = svd(block_dct_shuffled)
-        s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
-        if self.d2:
-            s[1] = (s[1] // self.d2 + 1 / 4 + 1 / 2 * wm_1) * self.d2
-
-        block_dct_flatten = np.dot(u, np.dot(np.diag(s), v)).flatten()
-        block_dct_flatten[shuffler] = block_dct_flatten.copy()
-        return idct(block_dct_flatten.reshape(self.block_shape))
+        return block_add_wm_slow(block, shuffler, self.block_bits(i), self.d1, self.d2)
 
     def block_add_wm_fast(self, arg):
-        # dct->svd->打水印->逆svd->逆dct
         block, shuffler, i = arg
-        wm_1 = self.wm_bit[i % self.wm_size]
-
-        u, s, v = svd(dct(block))
-        s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
-
-        return idct(np.dot(u, np.dot(np.diag(s), v)))
+        return block_add_wm_fast(block, self.block_bits(i), self.d1)
+
+    def is_vectorized(self):
+        # 在本进程内按区间批量处理分块，multithreading 模式下各区间分给线程池并行
+        return self.pool.mode in ('vectorization', 'cached', 'multithreading')
+
+    def is_shared(self):
+        # 多进程模式下用共享内存传输分块（需要 python>=3.8）
+        return self.pool.mode == 'multiprocessing' and shared_memory is not None
+
+    def batch_shuffle(self, index):
+        # 批量算子用的打乱顺序，fast_mode 不打乱
+        return None if self.fast_mode else self.idx_shuffle[index]
+
+    @property
+    def batch_d2(self):
+        # fast_mode 只量化第一个奇异值
+        return 0 if self.fast_mode else self.d2
+
+    def embed_strips(self, out=None):
+        '''
+        按水平条带嵌入：每条的高度是 8 的倍数，正好对齐 haar dwt（2 像素）+ 4x4 分块的网格，
+        因此每条的 dwt 系数、分块与整图处理时完全相同。分块的全局序号和打乱顺序在条带之间连续，
+        得到的图片与整图嵌入一致，可以用普通的 extract 提取
+        :param out: 预先分配的 uint8 输出，形状与原图相同，为空时新建
+        :return: uint8 的嵌入水印后的图片
+        '''
+        self.init_block_num()
+        img = self.img
+        block_h = 2 * self.block_shape[0]  # 一行分块对应的像素行数
+        rows_per_strip = max((self.strip_height or block_h) // block_h, 1)
+        n_block_rows, n_block_cols = self.ca_block_shape[:2]
+        if out is None:
+            out = np.empty(img.shape[:2] + (3 if self.alpha is None else 4,), dtype=np.uint8)
+
+        # 打乱顺序按分块序号依次从同一个随机数流中生成，与 random_strategy1 一次性生成的结果相同
+        random_state = np.random.RandomState(self.password_img)
+        block_size = self.block_shape[0] * self.block_shape[1]
+
+        for block_row_start in range(0, max(n_block_rows, 1), rows_per_strip):
+            block_row_end = min(block_row_start + rows_per_strip, n_block_rows)
+            y1 = block_row_start * block_h
+            # 最后一条包含下边不足一行分块的剩余像素
+            y2 = block_row_end * block_h if block_row_end < n_block_rows else self.img_shape[0]
+
+            with self.stats.stage('color_convert'):
+                strip_YUV = cv2.cvtColor(img[y1:y2, :, :3].astype(np.float32), cv2.COLOR_BGR2YUV)
+                strip_YUV = cv2.copyMakeBorder(strip_YUV, 0, (y2 - y1) % 2, 0, self.img_shape[1] % 2,
+                                               cv2.BORDER_CONSTANT, value=(0, 0, 0))
+
+            n_rows = block_row_end - block_row_start
+            block_idx = np.arange(block_row_start * n_block_cols, block_row_end * n_block_cols)
+            with self.stats.stage('key_material'):
+                shuffler = random_state.random(size=(block_idx.size, block_size)).argsort(axis=1)
+            wm_bits = self.block_bits(block_idx)
+
+            embed_YUV = [strip_YUV[:, :, channel] for channel in range(3)]
+            for channel in self.channels:
+                with self.stats.stage('dwt2'):
+                    ca, hvd = dwt2(strip_YUV[:, :, channel], 'haar')
+                # 条带内的分块，按全局序号的顺序排成 (n,4,4)
+                with self.stats.stage('block_split'):
+                    blocks = ca[:n_rows * self.block_shape[0], :self.part_shape[1]] \
+                        .reshape(n_rows, self.block_shape[0], n_block_cols, self.block_shape[1]) \
+                        .transpose(0, 2, 1, 3).reshape(-1, self.block_shape[0], self.block_shape[1])
+                with self.stats.stage('block_map[{}]'.format(CHANNEL_NAMES[channel])):
+                    blocks = self.embed_blocks(blocks, shuffler, wm_bits)
+                with self.stats.stage('block_split'):
+                    ca[:n_rows * self.block_shape[0], :self.part_shape[1]] = \
+                        blocks.reshape(n_rows, n_block_cols, self.block_shape[0], self.block_shape[1]) \
+                            .transpose(0, 2, 1, 3).reshape(n_rows * self.block_shape[0], self.part_shape[1])
+                with self.stats.stage('idwt2'):
+                    embed_YUV[channel] = idwt2((ca, hvd), 'haar')
+
+            with self.stats.stage('color_convert'):
+                embed_strip = cv2.cvtColor(np.stack(embed_YUV, axis=2)[:y2 - y1, :self.img_shape[1]],
+                                           cv2.COLOR_YUV2BGR)
+            with self.stats.stage('clip_convert'):
+                out[y1:y2, :, :3] = np.rint(np.clip(embed_strip, a_min=0, a_max=255))
+                if self.alpha is not None:
+                    out[y1:y2, :, 3] = self.alpha[y1:y2]
+        return out
+
+    def embed_blocks(self, blocks, shuffler, wm_bits):
+        # 嵌入一批 (n,4,4) 的分块
+        return add_wm_batch(blocks, None if self.fast_mode else shuffler, wm_bits, self.d1, self.batch_d2)
+
+    def embed(self, out=None):
+        '''
+        :param out: 预先分配的 uint8 输出（例如 numpy.memmap），形状与原图相同，为空时返回 float 图片
+        :return: 设置了 strip_height 时按条带取整，返回 uint8（见 embed_strips），否则返回限制在 [0, 255] 的 float32，
+            给了 out 时返回 out
+        '''
+        if self.strip_height:
+            return self.embed_strips(out=out)
 
-    def embed(self):
         self.init_block_index()
+        self.pool.reset_timings()
+
+        # 分块是 ca 上的视图，嵌入结果就地写回 ca，不再复制 ca、也不需要把分块拼回二维
+        for channel in self.channels:
+            stage = 'block_map[{}]'.format(CHANNEL_NAMES[channel])
+            with self.stats.stage(stage):
+                chunk_timings = self.embed_channel(channel)
+            self.stats.add_work(stage, chunk_timings)
+
+        # 逆变换回去，3 个通道直接写进同一个 buffer
+        with self.stats.stage('idwt2'):
+            embed_img_YUV = np.empty((self.ca_shape[0] * 2, self.ca_shape[1] * 2, 3), dtype=np.float32)
+            for channel in range(3):
+                if channel in self.channels:
+                    embed_img_YUV[:, :, channel] = idwt2((self.ca[channel], self.hvd[channel]), "haar")
+                else:
+                    embed_img_YUV[:, :, channel] = self.YUV_rest[channel]
 
-        embed_ca = copy.deepcopy(self.ca)
-        embed_YUV = [np.array([])] * 3
+        # 之前如果不是2的整数，增加了白边，这里去除掉
+        embed_img_YUV = embed_img_YUV[:self.img_shape[0], :self.img_shape[1]]
+        with self.stats.stage('color_convert'):
+            embed_img = cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR, dst=embed_img_YUV)
+
+        with self.stats.stage('clip_convert'):
+            np.clip(embed_img, a_min=0, a_max=255, out=embed_img)
+            if self.alpha is not None:
+                embed_img = cv2.merge([embed_img.astype(np.uint8), self.alpha])
+            if out is not None:
+                out[...] = np.rint(embed_img, out=embed_img) if self.alpha is None else embed_img
+                embed_img = out
+        return embed_img
 
-        self.idx_shuffle = random_strategy1(self.password_img, self.block_num,
-                                            self.block_shape[0] * self.block_shape[1])
-        for channel in range(3):
-            tmp = self.pool.map(self.block_add_wm,
-                                [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i], i)
+    def embed_channel(self, channel):
+        # 一个 channel 的所有分块嵌入水印，结果就地写回 ca，返回本次 worker 处理各区间的 (start, end, 耗时)
+        ca_block = self.ca_block[channel]
+        num_timings = len(self.pool.chunk_timings)
+        if self.is_vectorized():
+            # 分块切成若干连续区间，每个区间作为一个 (n,4,4) 批次处理，结果就地写回
+            def embed_chunk(start, end):
+                block_index = self.block_range(start, end)
+                ca_block[block_index] = add_wm_batch(ca_block[block_index], self.batch_shuffle(slice(start, end)),
+                                                     self.block_bits(np.arange(start, end)),
+                                                     self.d1, self.batch_d2)
+
+            self.pool.map_chunks(embed_chunk, self.block_num)
+        elif self.is_shared():
+            # 分块和打乱顺序放进共享内存，worker 按连续区间就地处理
+            embed_shared(self.pool, ca_block, self.batch_shuffle(slice(None)), self.embed_bit, self.d1, self.batch_d2,
+                         wm_size=self.wm_size, header=self.header)
+        else:
+            # 只把分块数据和参数发给 worker，不传 self（会连带整张图片一起被 pickle）
+            wm_bits = self.block_bits(np.arange(self.block_num))
+            tmp = self.pool.map(functools.partial(map_add_wm, d1=self.d1, d2=self.d2, fast_mode=self.fast_mode),
+                                [(ca_block[tuple(self.block_index[i])], self.idx_shuffle[i], wm_bits[i])
                                  for i in range(self.block_num)])
 
             for i in range(self.block_num):
-                self.ca_block[channel][self.block_index[i]] = tmp[i]
-
-            # 4维分块变回2维
-            self.ca_part[channel] = np.concatenate(np.concatenate(self.ca_block[channel], 1), 1)
-            # 4维分块时右边和下边不能整除的长条保留，其余是主体部分，换成 embed 之后的频域的数据
-            embed_ca[channel][:self.part_shape[0], :self.part_shape[1]] = self.ca_part[channel]
-            # 逆变换回去
-            embed_YUV[channel] = idwt2((embed_ca[channel], self.hvd[channel]), "haar")
-
-        # 合并3通道
-        embed_img_YUV = np.stack(embed_YUV, axis=2)
-        # 之前如果不是2的整数，增加了白边，这里去除掉
-        embed_img_YUV = embed_img_YUV[:self.img_shape[0], :self.img_shape[1]]
-        embed_img = cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR)
-        embed_img = np.clip(embed_img, a_min=0, a_max=255)
-
-        if self.alpha is not None:
-            embed_img = cv2.merge([embed_img.astype(np.uint8), self.alpha])
-        return embed_img
+                ca_block[tuple(self.block_index[i])] = tmp[i]
+        return self.pool.chunk_timings[num_timings:]
 
     def block_get_wm(self, args):
         if self.fast_mode:
@@ -145,77 +339,265 @@ class WaterMarkCore:
 
     def block_get_wm_slow(self, args):
         block, shuffler = args
-        # dct->flatten->加密->逆flatten->svd->解水印
-        block_dct_shuffled = dct(block).flatten()[shuffler].reshape(self.block_shape)
-
-        u, s, v = svd(block_dct_shuffled)
-        wm = (s[0] % self.d1 > self.d1 / 2) * 1
-        if self.d2:
-            tmp = (s[1] % self.d2 > self.d2 / 2) * 1
-            wm = (wm * 3 + tmp * 1) / 4
-        return wm
+        return block_get_wm_slow(block, shuffler, self.d1, self.d2)
 
     def block_get_wm_fast(self, args):
         block, shuffler = args
-        # dct->svd->解水印
-        u, s, v = svd(dct(block))
-        wm = (s[0] % self.d1 > self.d1 / 2) * 1
+        return block_get_wm_fast(block, self.d1)
 
-        return wm
+    def read_img_extract(self, img):
+        # img 为空时沿用上一次读入的图片（例如 extract_header 之后），只重新检查水印长度
+        if img is None:
+            self.init_block_num()
+        else:
+            self.read_img_arr(img=img)
+            self.init_block_index()
 
     def extract_raw(self, img):
         # 每个分块提取 1 bit 信息
-        self.read_img_arr(img=img)
-        self.init_block_index()
-
-        wm_block_bit = np.zeros(shape=(3, self.block_num))  # 3个channel，length 个分块提取的水印，全都记录下来
-
-        self.idx_shuffle = random_strategy1(seed=self.password_img,
-                                            size=self.block_num,
-                                            block_shape=self.block_shape[0] * self.block_shape[1],  # 16
-                                            )
-        for channel in range(3):
-            wm_block_bit[channel, :] = self.pool.map(self.block_get_wm,
-                                                     [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i])
-                                                      for i in range(self.block_num)])
+        self.read_img_extract(img)
+        self.pool.reset_timings()
+
+        # 每个所选 channel，length 个分块提取的水印，全都记录下来
+        wm_block_bit = np.zeros(shape=(len(self.channels), self.block_num))
+        with self.stats.stage('block_map'):
+            self.extract_blocks(wm_block_bit)
+        self.stats.add_work('block_map', self.pool.chunk_timings)
         return wm_block_bit
 
-    def extract_avg(self, wm_block_bit):
-        # 对循环嵌入+3个 channel 求平均
-        wm_avg = np.zeros(shape=self.wm_size)
-        for i in range(self.wm_size):
-            wm_avg[i] = wm_block_bit[:, i::self.wm_size].mean()
-        return wm_avg
+    def extract_blocks(self, wm_block_bit):
+        if self.is_vectorized() or self.is_shared():
+            # 所选 channel 的所有分块一次批量提取
+            if self.is_shared():
+                wm_block_bit[:] = extract_shared(self.pool, self.ca_block_all, self.batch_shuffle(slice(None)),
+                                                 self.d1, self.batch_d2)
+            else:
+                def extract_chunk(start, end):
+                    block_index = self.block_range(start, end)
+                    wm_block_bit[:, start:end] = get_wm_batch(self.ca_block_all[(slice(None),) + block_index],
+                                                              self.batch_shuffle(slice(start, end)),
+                                                              self.d1, self.batch_d2)
+
+                self.pool.map_chunks(extract_chunk, self.block_num)
+            return
+
+        for idx, channel in enumerate(self.channels):
+            wm_block_bit[idx, :] = self.pool.map(
+                functools.partial(map_get_wm, d1=self.d1, d2=self.d2, fast_mode=self.fast_mode),
+                [(self.ca_block[channel][tuple(self.block_index[i])], self.idx_shuffle[i])
+                 for i in range(self.block_num)])
+
+    def extract_raw_progressive(self, img, threshold):
+        '''
+        渐进式提取：按 PROGRESSIVE_ORDER 分轮处理水印的各次重复，每轮均匀覆盖整张图的 1/8，
+        所有 bit 的可信度都达到 threshold 后提前结束，只处理一部分分块
+        :return: wm_block_bit，没有处理到的分块为 nan
+        '''
+        self.read_img_extract(img)
+        self.pool.reset_timings()
+
+        wm_block_bit = np.full(shape=(len(self.channels), self.block_num), fill_value=np.nan)
+        # 放水印的分块，以及每个分块属于水印的第几次重复
+        wm_blocks = np.flatnonzero(payload_mask(self.block_num)) if self.header else np.arange(self.block_num)
+        repeat_idx = np.arange(wm_blocks.size) // self.wm_size
+        for offset in PROGRESSIVE_ORDER:
+            idx = wm_blocks[repeat_idx % len(PROGRESSIVE_ORDER) == offset]
+            if idx.size == 0:
+                continue
+            with self.stats.stage('block_map'):
+                block_index = tuple(self.block_index[idx].T)
+                blocks = self.ca_block_all[(slice(None),) + block_index]
+                wm_block_bit[:, idx] = get_wm_batch(blocks, self.batch_shuffle(idx), self.d1, self.batch_d2)
+            with self.stats.stage('average'):
+                confident = self.extract_bit_confidence(wm_block_bit).min() >= threshold
+            if confident:
+                break
+        return wm_block_bit
 
-    def extract(self, img, wm_shape):
+    def extract_header(self, img):
+        '''
+        读入图片，只处理放头部的分块，之后 extract 时传 img=None 复用已经读入的图片
+        :return: (HEADER_BITS,) 头部每个 bit 的平均值，用 header.decode_header 解码
+        '''
+        self.wm_size = 0
+        self.read_img_extract(img)
+        idx = header_blocks(self.block_num)
+        with self.stats.stage('header'):
+            blocks = self.ca_block_all[(slice(None),) + tuple(self.block_index[idx].T)]
+            header_block_bit = get_wm_batch(blocks, self.batch_shuffle(idx), self.d1, self.batch_d2)
+            # 与水印相同，按头部 bit 分组求平均
+            repeats = -(-idx.size // HEADER_BITS)
+            padded = np.full((header_block_bit.shape[0], repeats * HEADER_BITS), np.nan)
+            padded[:, :idx.size] = header_block_bit
+            return np.nanmean(padded.reshape(-1, HEADER_BITS), axis=0)
+
+    def reshape_by_bit(self, wm_block_bit, wm_size=None):
+        # 末尾补 nan 到 wm_size 的整数倍，变成 (channel, 重复次数, wm_size)，第 i 列就是第 i 个 bit 的所有副本
+        # 带头部时先去掉放头部的分块；wm_size 为空时用 self.wm_size
+        wm_size = wm_size or self.wm_size
+        if self.header:
+            wm_block_bit = wm_block_bit[:, payload_mask(wm_block_bit.shape[1])]
+        repeats = -(-wm_block_bit.shape[1] // wm_size)
+        padded = np.full((wm_block_bit.shape[0], repeats * wm_size), np.nan)
+        padded[:, :wm_block_bit.shape[1]] = wm_block_bit
+        return padded.reshape(wm_block_bit.shape[0], repeats, wm_size)
+
+    def extract_avg(self, wm_block_bit, wm_size=None):
+        # 对循环嵌入+所有 channel 求平均，channel 数可以是 1~3，忽略没有处理到的分块（nan）
+        return np.nanmean(self.reshape_by_bit(wm_block_bit, wm_size), axis=(0, 1))
+
+    def extract_bit_confidence(self, wm_block_bit, wm_size=None):
+        '''
+        每个 bit 的可信度，由它的所有冗余副本（channel 数 × 重复次数）的离散程度得出：
+        均值偏离 0.5 的距离除以均值的标准误差得到 z，可信度为 1 - exp(-z^2 / 2)，取值 [0, 1)
+        方差里加了一个 0.25（0/1 等概率时的方差）的先验，副本很少时不会因为方差为 0 而过度自信
+        '''
+        copies = self.reshape_by_bit(wm_block_bit, wm_size)
+        count = np.maximum((~np.isnan(copies)).sum(axis=(0, 1)), 1)
+        wm_avg = np.nan_to_num(np.nansum(copies, axis=(0, 1)) / count)
+        sq_dev = np.nansum((copies - wm_avg) ** 2, axis=(0, 1))
+        std_err = np.sqrt((sq_dev + 0.25) / count / count)
+        z = np.abs(wm_avg - 0.5) / std_err
+        return 1 - np.exp(-z ** 2 / 2)
+
+    def extract_block_bit(self, img, wm_shape, early_exit=None):
+        '''
+        :param early_exit: float or None
+            If not None, extract progressively and stop once every bit's confidence reaches early_exit
+        :return: wm_block_bit
+        '''
         self.wm_size = np.array(wm_shape).prod()
 
         # 提取每个分块埋入的 bit：
-        wm_block_bit = self.extract_raw(img=img)
+        if early_exit is None:
+            wm_block_bit = self.extract_raw(img=img)
+        else:
+            wm_block_bit = self.extract_raw_progressive(img=img, threshold=early_exit)
+        self.blocks_used = int((~np.isnan(wm_block_bit[0])).sum())  # 实际处理的分块数
+        return wm_block_bit
+
+    def extract(self, img, wm_shape, early_exit=None):
+        wm_block_bit = self.extract_block_bit(img=img, wm_shape=wm_shape, early_exit=early_exit)
         # 做平均：
         wm_avg = self.extract_avg(wm_block_bit)
         return wm_avg
 
+    def extract_with_confidence(self, img, wm_shape, early_exit=None):
+        # 返回 wm_avg 和每个 bit 的可信度
+        wm_block_bit = self.extract_block_bit(img=img, wm_shape=wm_shape, early_exit=early_exit)
+        with self.stats.stage('average'):
+            return self.extract_avg(wm_block_bit), self.extract_bit_confidence(wm_block_bit)
+
     def extract_with_kmeans(self, img, wm_shape):
         wm_avg = self.extract(img=img, wm_shape=wm_shape)
 
         return one_dim_kmeans(wm_avg)
 
 
+# 逐块嵌入/提取的算子，放在模块级别，多进程时只需 pickle 分块数据和 d1/d2 等参数
+def block_add_wm_slow(block, shuffler, wm_1, d1, d2):
+    # dct->(flatten->加密->逆flatten)->svd->打水印->逆svd->(flatten->解密->逆flatten)->逆dct
+    block_shape = block.shape
+    block_dct = dct(block)
+
+    # 加密（打乱顺序）
+    block_dct_shuffled = block_dct.flatten()[shuffler].reshape(block_shape)
+    u, s, v = svd(block_dct_shuffled)
+    s[0] = (s[0] // d1 + 1 / 4 + 1 / 2 * wm_1) * d1
+    if d2:
+        s[1] = (s[1] // d2 + 1 / 4 + 1 / 2 * wm_1) * d2
+
+    block_dct_flatten = np.dot(u, np.dot(np.diag(s), v)).flatten()
+    block_dct_flatten[shuffler] = block_dct_flatten.copy()
+    return idct(block_dct_flatten.reshape(block_shape))
+
+
+def block_add_wm_fast(block, wm_1, d1):
+    # dct->svd->打水印->逆svd->逆dct
+    u, s, v = svd(dct(block))
+    s[0] = (s[0] // d1 + 1 / 4 + 1 / 2 * wm_1) * d1
+
+    return idct(np.dot(u, np.dot(np.diag(s), v)))
+
+
+def block_get_wm_slow(block, shuffler, d1, d2):
+    # dct->flatten->加密->逆flatten->svd->解水印
+    block_dct_shuffled = dct(block).flatten()[shuffler].reshape(block.shape)
+
+    u, s, v = svd(block_dct_shuffled)
+    wm = (s[0] % d1 > d1 / 2) * 1
+    if d2:
+        tmp = (s[1] % d2 > d2 / 2) * 1
+        wm = (wm * 3 + tmp * 1) / 4
+    return wm
+
+
+def block_get_wm_fast(block, d1):
+    # dct->svd->解水印
+    u, s, v = svd(dct(block))
+    wm = (s[0] % d1 > d1 / 2) * 1
+
+    return wm
+
+
+def map_add_wm(arg, d1, d2, fast_mode=False):
+    block, shuffler, wm_1 = arg
+    if fast_mode:
+        return block_add_wm_fast(block, wm_1, d1)
+    return block_add_wm_slow(block, shuffler, wm_1, d1, d2)
+
+
+def map_get_wm(arg, d1, d2, fast_mode=False):
+    block, shuffler = arg
+    if fast_mode:
+        return block_get_wm_fast(block, d1)
+    return block_get_wm_slow(block, shuffler, d1, d2)
+
+
+# 渐进式提取时水印各次重复的处理顺序（按重复序号对 8 取余，位反转顺序），前几轮就能均匀覆盖整张图
+PROGRESSIVE_ORDER = (0, 4, 2, 6, 1, 5, 3, 7)
+
+
 def one_dim_kmeans(inputs):
+    threshold, _ = kmeans_threshold(inputs)
+    is_class01 = inputs > threshold
+    return is_class01
+
+
+def kmeans_threshold(inputs):
+    # 与逐点归类的 k-means 迭代完全相同，但先排序并求前缀和，每次迭代只需一次二分查找
+    # 返回 (阈值, [第 0 类中心, 第 1 类中心])
+    sorted_inputs = np.sort(inputs)
+    cum_sum = np.concatenate([[0], np.cumsum(sorted_inputs)])
+    size = sorted_inputs.size
+
     threshold = 0
     e_tol = 10 ** (-6)
-    center = [inputs.min(), inputs.max()]  # 1. 初始化中心点
+    center = [sorted_inputs[0], sorted_inputs[-1]]  # 1. 初始化中心点
     for i in range(300):
         threshold = (center[0] + center[1]) / 2
-        is_class01 = inputs > threshold  # 2. 检查所有点与这k个点之间的距离，每个点归类到最近的中心
-        center = [inputs[~is_class01].mean(), inputs[is_class01].mean()]  # 3. 重新找中心点
+        num_class0 = np.searchsorted(sorted_inputs, threshold, side='right')  # 2. 不大于阈值的归为第 0 类
+        if num_class0 in (0, size):
+            break
+        center = [cum_sum[num_class0] / num_class0,
+                  (cum_sum[size] - cum_sum[num_class0]) / (size - num_class0)]  # 3. 重新找中心点
         if np.abs((center[0] + center[1]) / 2 - threshold) < e_tol:  # 4. 停止条件
             threshold = (center[0] + center[1]) / 2
             break
 
-    is_class01 = inputs > threshold
-    return is_class01
+    return threshold, center
+
+
+def parse_channels(channels):
+    '''
+    :param channels: 'YUV' 中字母组成的字符串（如 'Y'、'YU'），或 0/1/2 组成的序列
+    :return: 排好序的通道序号 tuple
+    '''
+    if isinstance(channels, str):
+        channels = ['YUV'.index(c) for c in channels.upper()]
+    channels = tuple(sorted(set(int(c) for c in channels)))
+    assert channels and set(channels) <= {0, 1, 2}, 'channels should be a non-empty subset of Y, U, V'
+    return channels
 
 
 def random_strategy1(seed, size, block_shape):
@@ -1,9 +1,11 @@
+import os
 from optparse import OptionParser
 from .blind_watermark import WaterMark
 
 usage1 = 'blind_watermark --embed --pwd 1234 image.jpg "watermark text" embed.png'
+usage1_batch = 'blind_watermark --embed --pwd 1234 image_dir "watermark text" output_dir'
 usage2 = 'blind_watermark --extract --pwd 1234 --wm_shape 111 embed.png'
-optParser = OptionParser(usage=usage1 + '\n' + usage2)
+optParser = OptionParser(usage=usage1 + '\n' + usage1_batch + '\n' + usage2)
 
 optParser.add_option('--embed', dest='work_mode', action='store_const', const='embed'
                      , help='Embed watermark into images')
@@ -12,23 +14,56 @@ optParser.add_option('--extract', dest='work_mode', action='store_const', const=
 
 optParser.add_option('-p', '--pwd', dest='password', help='password, like 1234')
 optParser.add_option('--wm_shape', dest='wm_shape', help='Watermark shape, like 120')
+optParser.add_option('--workers', dest='workers', type='int', help='Number of images processed concurrently in batch mode')
+optParser.add_option('--fast', dest='fast_mode', action='store_true', default=False,
+                     help='Fast mode: faster but less robust, extraction must also use --fast (detected with --header)')
+optParser.add_option('--header', dest='header', action='store_true', default=False,
+                     help='Embed a header with the watermark length, extraction with --header needs no --wm_shape')
+optParser.add_option('--ecc', dest='ecc', action='store_true', default=False,
+                     help='Error correcting code: survives stronger attacks, extraction must also use --ecc or --header')
 
 (opts, args) = optParser.parse_args()
 
 
+def print_embed_notes(bwm):
+    if opts.header:
+        print('Embedded with a header, extract with --header, no --wm_shape needed')
+    else:
+        print('Put down watermark size:', len(bwm.wm_bit))
+    if opts.fast_mode and not opts.header:
+        print('Embedded in fast mode, extract with --fast')
+    if opts.ecc and not opts.header:
+        print('Embedded with ecc, extract with --ecc')
+
+
 def main():
-    bwm1 = WaterMark(password_img=int(opts.password))
+    bwm1 = WaterMark(password_img=int(opts.password), fast_mode=opts.fast_mode, header=opts.header,
+                     ecc=opts.ecc)
     if opts.work_mode == 'embed':
         if not len(args) == 3:
             print('Error! Usage: ')
             print(usage1)
+            print(usage1_batch)
             return
+        elif os.path.isdir(args[0]):
+            # 批量模式：args[0] 是图片目录，args[2] 是输出目录
+            bwm1.read_wm(args[1], mode='str')
+            num_ok, num_fail = 0, 0
+            for filename, out_filename, status in bwm1.embed_many(args[0], args[2], workers=opts.workers):
+                if status == 'ok':
+                    num_ok += 1
+                    print('Embed succeed! to file ', out_filename)
+                else:
+                    num_fail += 1
+                    print('Embed failed!', filename, status)
+            print('Embed finished, {} succeed, {} failed'.format(num_ok, num_fail))
+            print_embed_notes(bwm1)
         else:
             bwm1.read_img(args[0])
             bwm1.read_wm(args[1], mode='str')
             bwm1.embed(args[2])
             print('Embed succeed! to file ', args[2])
-            print('Put down watermark size:', len(bwm1.wm_bit))
+            print_embed_notes(bwm1)
 
     if opts.work_mode == 'extract':
         if not len(args) == 1:
@@ -37,14 +72,22 @@ def main():
             return
 
         else:
-            wm_str = bwm1.extract(filename=args[0], wm_shape=int(opts.wm_shape), mode='str')
+            wm_shape = int(opts.wm_shape) if opts.wm_shape else None
+            wm_str = bwm1.extract(filename=args[0], wm_shape=wm_shape, mode='str')
             print('Extract succeed! watermark is:')
             print(wm_str)
 
 
 '''
 python -m blind_watermark.cli_tools --embed --pwd 1234 examples/pic/ori_img.jpeg "watermark text" examples/output/embedded.png
+python -m blind_watermark.cli_tools --embed --pwd 1234 --workers 4 examples/pic "watermark text" examples/output
 python -m blind_watermark.cli_tools --extract --pwd 1234 --wm_shape 111 examples/output/embedded.png
+python -m blind_watermark.cli_tools --embed --fast --pwd 1234 examples/pic/ori_img.jpeg "watermark text" examples/output/embedded.png
+python -m blind_watermark.cli_tools --extract --fast --pwd 1234 --wm_shape 111 examples/output/embedded.png
+python -m blind_watermark.cli_tools --embed --header --pwd 1234 examples/pic/ori_img.jpeg "watermark text" examples/output/embedded.png
+python -m blind_watermark.cli_tools --extract --header --pwd 1234 examples/output/embedded.png
+python -m blind_watermark.cli_tools --embed --ecc --pwd 1234 examples/pic/ori_img.jpeg "watermark text" examples/output/embedded.png
+python -m blind_watermark.cli_tools --extract --ecc --pwd 1234 --wm_shape 234 examples/output/embedded.png
 
 
 cd examples
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 纠错编码：码率 1/2、约束长度 7 的卷积码（生成多项式 133, 171 八进制），软判决 Viterbi 译码
+# 编码在加密（打乱顺序）之前进行，打乱顺序同时起到交织的作用，遮挡等攻击造成的连续错误被分散开
+# 译码直接使用 extract_avg 的平均值（0~1 之间，越接近 1 越可能是 1）作为软信息，不先做 kmeans 硬判决
+import numpy as np
+
+CONSTRAINT_LENGTH = 7
+GENERATORS = (0o133, 0o171)
+MEMORY = CONSTRAINT_LENGTH - 1
+NUM_STATES = 1 << MEMORY
+
+
+def generator_taps(generator):
+    # 第 k 位对应 k 步之前的输入
+    return (generator >> np.arange(CONSTRAINT_LENGTH)) & 1
+
+
+def parity(x):
+    x = np.asarray(x)
+    out = np.zeros(x.shape, dtype=np.int64)
+    for k in range(CONSTRAINT_LENGTH):
+        out ^= (x >> k) & 1
+    return out
+
+
+def encoded_size(size):
+    # size 个 bit 编码后的长度，包含让编码器回到 0 状态的 MEMORY 个尾比特
+    return len(GENERATORS) * (size + MEMORY)
+
+
+def decoded_size(size):
+    return size // len(GENERATORS) - MEMORY
+
+
+def encode(bits):
+    '''
+    :param bits: (n,) bool or 0/1
+    :return: (encoded_size(n),) bool，每个输入 bit 依次输出两个生成多项式的校验位
+    '''
+    bits = np.asarray(bits, dtype=np.int64)
+    out = np.empty((bits.size + MEMORY, len(GENERATORS)), dtype=bool)
+    for j, generator in enumerate(GENERATORS):
+        # 末尾补 MEMORY 个 0，完整卷积正好得到带尾比特的输出
+        out[:, j] = np.convolve(bits, generator_taps(generator)) % 2
+    return out.reshape(-1)
+
+
+# 网格图：状态为最近 MEMORY 个输入（最低位是最新的），新状态 ns 的两个前驱 ns >> 1 和 (ns >> 1) | 高位，
+# 输入 bit 为 ns & 1，寄存器为 (前驱 << 1) | 输入
+_next_states = np.arange(NUM_STATES)
+PREDECESSORS = np.stack([_next_states >> 1, (_next_states >> 1) | (NUM_STATES >> 1)])
+# 两个前驱转移到 ns 时的输出，编码为 0~3 的整数（第一个生成多项式的校验位在高位）
+BRANCH_OUTPUTS = np.stack([
+    sum(parity(register & generator) << (len(GENERATORS) - 1 - j) for j, generator in enumerate(GENERATORS))
+    for register in (_next_states, _next_states | NUM_STATES)])
+
+
+def decode(soft_bits):
+    '''
+    软判决 Viterbi 译码
+    :param soft_bits: (encoded_size(n),) 每个编码 bit 为 1 的程度，0~1，nan 视为 0.5（没有信息）
+    :return: (n,) bool
+    '''
+    soft = np.nan_to_num(np.asarray(soft_bits, dtype=np.float64).reshape(-1, len(GENERATORS)), nan=0.5)
+    steps = soft.shape[0]
+    # 每一步 4 种可能输出的分支度量（与软信息的平方距离），一次算出所有步
+    outputs = (np.arange(1 << len(GENERATORS))[:, None] >> np.arange(len(GENERATORS) - 1, -1, -1)) & 1
+    branch_costs = ((soft[:, None, :] - outputs[None, :, :]) ** 2).sum(axis=2)  # (steps, 4)
+
+    metrics = np.full(NUM_STATES, np.inf)
+    metrics[0] = 0  # 编码器从 0 状态开始
+    decisions = np.empty((steps, NUM_STATES), dtype=bool)  # True 表示走的是第二个前驱
+    for t in range(steps):
+        cost = branch_costs[t]
+        cand0 = metrics[PREDECESSORS[0]] + cost[BRANCH_OUTPUTS[0]]
+        cand1 = metrics[PREDECESSORS[1]] + cost[BRANCH_OUTPUTS[1]]
+        decisions[t] = cand1 < cand0
+        metrics = np.where(decisions[t], cand1, cand0)
+
+    # 尾比特让编码器回到 0 状态，从 0 状态回溯
+    state, bits = 0, np.empty(steps, dtype=bool)
+    for t in range(steps - 1, -1, -1):
+        bits[t] = state & 1
+        state = PREDECESSORS[int(decisions[t, state]), state]
+    return bits[:steps - MEMORY]
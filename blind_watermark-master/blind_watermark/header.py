@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 自描述头：把水印的类型（img/str/bit）和形状编码成 HEADER_BITS 个 bit，嵌入固定的一组分块中，
+# 提取时先只处理这些分块解出头部，就知道水印的长度，不需要再提供 wm_shape
+#
+# 分块布局：序号 i % HEADER_INTERVAL == 0 的分块放头部，第 i // HEADER_INTERVAL % HEADER_BITS 个 bit，
+# 其余分块按顺序循环放水印，与水印的长度无关，因此头部的位置在提取时是已知的
+#
+# 头部格式（64 bit，高位在前）：版本 4 bit | 类型 2 bit | 纠错编码 1 bit | 保留 1 bit | 形状 24 bit x 2 | CRC-8，
+# 与由 password_wm 生成的随机掩码异或后嵌入
+import numpy as np
+
+HEADER_VERSION = 1
+HEADER_BITS = 64
+HEADER_INTERVAL = 16
+HEADER_MODES = ('img', 'str', 'bit')
+DIM_BITS = 24
+
+
+def bit_index(idx, wm_size, header=False):
+    '''
+    分块序号 -> 在嵌入序列中的位置
+    不带头部时嵌入序列就是水印，带头部时是 HEADER_BITS 个头部 bit 再接水印
+    '''
+    if not header:
+        return idx % wm_size
+    return np.where(idx % HEADER_INTERVAL == 0, idx // HEADER_INTERVAL % HEADER_BITS,
+                    HEADER_BITS + (idx - idx // HEADER_INTERVAL - 1) % wm_size)
+
+
+def header_blocks(block_num):
+    # 放头部的分块序号
+    return np.arange(0, block_num, HEADER_INTERVAL)
+
+
+def payload_mask(block_num):
+    # 放水印的分块，按序号排列后第 p 个分块放水印的第 p % wm_size 个 bit
+    return np.arange(block_num) % HEADER_INTERVAL != 0
+
+
+def payload_capacity(block_num):
+    return block_num - -(-block_num // HEADER_INTERVAL)
+
+
+def to_bits(value, n):
+    return (int(value) >> np.arange(n - 1, -1, -1)) & 1 == 1
+
+
+def from_bits(bits):
+    return int(np.dot(bits.astype(np.int64), 1 << np.arange(bits.size - 1, -1, -1, dtype=np.int64)))
+
+
+def crc8(bits):
+    # CRC-8（多项式 x^8+x^2+x+1），头部只有几十个 bit，逐位计算即可
+    crc = 0
+    for bit in bits:
+        crc ^= int(bit) << 7
+        crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def header_mask(password_wm):
+    return np.random.RandomState(password_wm).randint(0, 2, size=HEADER_BITS).astype(bool)
+
+
+def encode_header(mode, wm_shape, password_wm, ecc=False):
+    '''
+    :param mode: 'img', 'str' or 'bit'
+    :param wm_shape: (height, width) in img mode, otherwise the number of bits
+    :param ecc: whether the watermark is protected by ecc
+    :return: (HEADER_BITS,) bool
+    '''
+    shape = tuple(np.atleast_1d(wm_shape).astype(int))
+    if mode != 'img':
+        shape = (int(np.prod(shape)), 0)
+    assert max(shape) < 2 ** DIM_BITS, 'watermark too large for the header'
+    bits = np.concatenate([to_bits(HEADER_VERSION, 4), to_bits(HEADER_MODES.index(mode), 2),
+                           to_bits(int(bool(ecc)), 1), to_bits(0, 1),
+                           to_bits(shape[0], DIM_BITS), to_bits(shape[1], DIM_BITS)])
+    bits = np.concatenate([bits, to_bits(crc8(bits), 8)])
+    return bits ^ header_mask(password_wm)
+
+
+def decode_header(header_avg, password_wm):
+    '''
+    :param header_avg: (HEADER_BITS,) 头部分块提取结果的平均值
+    :return: (wm_shape, mode, ecc)
+    '''
+    bits = (np.asarray(header_avg) >= 0.5) ^ header_mask(password_wm)
+    if crc8(bits[:-8]) != from_bits(bits[-8:]) or from_bits(bits[:4]) != HEADER_VERSION \
+            or from_bits(bits[4:6]) >= len(HEADER_MODES):
+        raise ValueError('watermark header not found, the image has no header, '
+                         'or password_wm/password_img/channels do not match')
+    mode = HEADER_MODES[from_bits(bits[4:6])]
+    dim0, dim1 = from_bits(bits[8:8 + DIM_BITS]), from_bits(bits[8 + DIM_BITS:8 + 2 * DIM_BITS])
+    return ((dim0, dim1) if mode == 'img' else dim0), mode, bool(bits[6])
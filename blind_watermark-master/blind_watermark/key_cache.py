@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 密钥材料缓存：同一个 password_img 下，同样尺寸的图片，分块打乱顺序和分块索引是完全一样的
+# 批量处理同尺寸图片时，只在第一张图上生成一次，之后直接复用
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class KeyCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_items=64):
+        self.max_bytes, self.max_items = max_bytes, max_items
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, password_img, ca_block_shape):
+        '''
+        :param password_img: 图片密码
+        :param ca_block_shape: 四维分块的形状 (行数, 列数, 块高, 块宽)
+        :return: (idx_shuffle, block_index)，都是只读 array，不要修改
+        '''
+        key = (password_img, tuple(int(i) for i in ca_block_shape))
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+
+        value = make_key_material(password_img, ca_block_shape)
+        size = sum(arr.nbytes for arr in value)
+
+        with self._lock:
+            if key not in self._data and size <= self.max_bytes:
+                self._data[key] = value
+                self.nbytes += size
+                # LRU 淘汰，直到满足个数和内存上限
+                while len(self._data) > self.max_items or self.nbytes > self.max_bytes:
+                    _, old_value = self._data.popitem(last=False)
+                    self.nbytes -= sum(arr.nbytes for arr in old_value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+def make_key_material(password_img, ca_block_shape, chunk=65536):
+    block_num = ca_block_shape[0] * ca_block_shape[1]
+    block_size = ca_block_shape[2] * ca_block_shape[3]
+    # 打乱顺序取值都小于 block_size，4x4 分块用 uint8 存，内存只有 int64 的 1/8
+    idx_dtype = np.uint8 if block_size <= 256 else np.intp
+    # 与 random_strategy1 相同的随机数流，分段生成和排序，临时的 float64/int64 数组只有 chunk 行
+    random_state = np.random.RandomState(password_img)
+    idx_shuffle = np.empty((block_num, block_size), dtype=idx_dtype)
+    for start in range(0, block_num, chunk):
+        end = min(start + chunk, block_num)
+        idx_shuffle[start:end] = random_state.random(size=(end - start, block_size)).argsort(axis=1)
+    block_index = np.indices(ca_block_shape[:2]).reshape(2, -1).T
+    idx_shuffle.setflags(write=False)
+    block_index.setflags(write=False)
+    return idx_shuffle, block_index
+
+
+key_cache = KeyCache()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 超大图片的内存映射读写：原始像素文件（raw）和未压缩的 TIFF
+# 返回的 numpy.memmap 可以直接传给 WaterMark.read_img(img=...)，配合 strip_height 分条嵌入，
+# 并作为 WaterMark.embed(out=...) 的预分配输出，整个过程不需要把整张图读进内存
+import struct
+
+import numpy as np
+
+
+def open_raw(filename, shape, planar=False, mode='r'):
+    '''
+    :param shape: (height, width, channels)
+    :param planar: bool
+        False: pixels are stored interleaved as BGRBGR..., True: each channel is stored as a whole plane
+    :param mode: same as numpy.memmap, 'r' for input, 'w+' to create an output
+    :return: (height, width, channels) uint8 memmap (a transposed view of it if planar)
+    '''
+    height, width, channels = shape
+    if planar:
+        return np.memmap(filename, dtype=np.uint8, mode=mode, shape=(channels, height, width)).transpose(1, 2, 0)
+    return np.memmap(filename, dtype=np.uint8, mode=mode, shape=(height, width, channels))
+
+
+def create_raw(filename, shape, planar=False):
+    return open_raw(filename, shape, planar=planar, mode='w+')
+
+
+# TIFF 标签
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION, PHOTOMETRIC = 256, 257, 258, 259, 262
+STRIP_OFFSETS, SAMPLES_PER_PIXEL, ROWS_PER_STRIP, STRIP_BYTE_COUNTS, PLANAR_CONFIG = 273, 277, 278, 279, 284
+# TIFF 数据类型 -> struct 格式
+TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+
+
+def read_tiff_tags(f):
+    # 读第一个 IFD 中的标签，支持普通 TIFF 和 BigTIFF
+    byte_order = {b'II': '<', b'MM': '>'}[f.read(2)]
+    version, = struct.unpack(byte_order + 'H', f.read(2))
+    if version == 43:  # BigTIFF
+        f.read(4)
+        count_fmt, entry_size, inline_size = 'Q', 20, 8
+        ifd_offset, = struct.unpack(byte_order + 'Q', f.read(8))
+    else:
+        count_fmt, entry_size, inline_size = 'H', 12, 4
+        ifd_offset, = struct.unpack(byte_order + 'I', f.read(4))
+
+    f.seek(ifd_offset)
+    num_entries, = struct.unpack(byte_order + count_fmt, f.read(struct.calcsize(count_fmt)))
+    entries = f.read(num_entries * entry_size)
+    tags = dict()
+    for i in range(num_entries):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, dtype = struct.unpack(byte_order + 'HH', entry[:4])
+        if dtype not in TIFF_TYPES:
+            continue
+        count, = struct.unpack(byte_order + count_fmt.replace('H', 'I'), entry[4:entry_size - inline_size])
+        fmt = byte_order + TIFF_TYPES[dtype] * count
+        if struct.calcsize(fmt) <= inline_size:
+            values = struct.unpack(fmt, entry[entry_size - inline_size:][:struct.calcsize(fmt)])
+        else:
+            offset, = struct.unpack(byte_order + ('Q' if inline_size == 8 else 'I'), entry[-inline_size:])
+            position = f.tell()
+            f.seek(offset)
+            values = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+            f.seek(position)
+        tags[tag] = values
+    return tags
+
+
+def open_tiff(filename, mode='r'):
+    '''
+    把未压缩、8 bit、RGB 的 TIFF 映射为 (height, width, 3) 的 BGR memmap（通道倒序的视图，不复制数据）
+    只支持像素数据在文件中连续存放的 TIFF（单条带，或多个条带首尾相接），否则抛出 ValueError
+    '''
+    with open(filename, 'rb') as f:
+        tags = read_tiff_tags(f)
+
+    width, height = tags[IMAGE_WIDTH][0], tags[IMAGE_LENGTH][0]
+    channels = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+    planar = tags.get(PLANAR_CONFIG, (1,))[0] == 2
+    offsets, byte_counts = tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS]
+    if tags.get(COMPRESSION, (1,))[0] != 1:
+        raise ValueError('only uncompressed TIFF can be memory-mapped')
+    if set(tags[BITS_PER_SAMPLE]) != {8} or channels != 3 or tags.get(PHOTOMETRIC, (2,))[0] != 2:
+        raise ValueError('only 8-bit RGB TIFF can be memory-mapped')
+    if any(offsets[i] + byte_counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)) \
+            or sum(byte_counts) != width * height * channels:
+        raise ValueError('pixel data of the TIFF is not contiguous')
+
+    shape = (channels, height, width) if planar else (height, width, channels)
+    img = np.memmap(filename, dtype=np.uint8, mode=mode, offset=offsets[0], shape=shape)
+    if planar:
+        img = img.transpose(1, 2, 0)
+    return img[:, :, ::-1]
+
+
+def create_tiff(filename, shape):
+    '''
+    新建一个未压缩、8 bit、RGB 的 TIFF（超过 4GB 时为 BigTIFF），返回可写的 (height, width, 3) BGR memmap
+    :param shape: (height, width) or (height, width, 3)
+    '''
+    height, width = shape[:2]
+    data_size = height * width * 3
+    big = data_size + 1024 >= 2 ** 32
+
+    if big:
+        count_fmt, value_fmt, entry_fmt = 'Q', 'Q', '<HHQ'
+        header = struct.pack('<2sHHHQ', b'II', 43, 8, 0, 16)
+    else:
+        count_fmt, value_fmt, entry_fmt = 'H', 'I', '<HHI'
+        header = struct.pack('<2sHI', b'II', 42, 8)
+    long_type = 16 if big else 4
+
+    num_entries = 10
+    ifd_size = struct.calcsize('<' + count_fmt) + num_entries * struct.calcsize(entry_fmt + value_fmt) \
+        + struct.calcsize('<' + value_fmt)
+    bits_offset = len(header) + ifd_size
+    data_offset = bits_offset + 8
+
+    entries = [(IMAGE_WIDTH, long_type, width), (IMAGE_LENGTH, long_type, height),
+               (BITS_PER_SAMPLE, 3, None), (COMPRESSION, 3, 1), (PHOTOMETRIC, 3, 2),
+               (STRIP_OFFSETS, long_type, data_offset), (SAMPLES_PER_PIXEL, 3, 3),
+               (ROWS_PER_STRIP, long_type, height), (STRIP_BYTE_COUNTS, long_type, data_size),
+               (PLANAR_CONFIG, 3, 1)]
+    ifd = struct.pack('<' + count_fmt, num_entries)
+    inline_size = struct.calcsize('<' + value_fmt)
+    for tag, dtype, value in entries:
+        if tag == BITS_PER_SAMPLE:
+            # 3 个 SHORT 在 BigTIFF 中可以直接放进值字段，普通 TIFF 中放在 IFD 之后
+            count, packed = 3, struct.pack('<HHH', 8, 8, 8)
+            if len(packed) > inline_size:
+                packed = struct.pack('<' + value_fmt, bits_offset)
+        else:
+            count, packed = 1, struct.pack('<' + TIFF_TYPES[dtype], value)
+        # 小于字段宽度的值左对齐存放
+        ifd += struct.pack(entry_fmt, tag, dtype, count) + packed.ljust(inline_size, b'\0')
+    ifd += struct.pack('<' + value_fmt, 0)
+
+    with open(filename, 'wb') as f:
+        f.write(header + ifd + struct.pack('<HHHH', 8, 8, 8, 0))
+        f.truncate(data_offset + data_size)
+
+    return open_tiff(filename, mode='r+')
@@ -1,4 +1,8 @@
+import os
 import sys
+import time
+import atexit
+import threading
 import multiprocessing
 import warnings
 
@@ -11,8 +15,53 @@ class CommonPool(object):
         return list(map(func, args))
 
 
+# 进程级共享的线程池/进程池，按 (mode, processes) 只创建一次，所有 WaterMark 实例复用
+_shared_pools = dict()
+_shared_lock = threading.Lock()
+
+
+def get_shared_pool(mode, processes=None):
+    key = (mode, processes)
+    with _shared_lock:
+        pool = _shared_pools.get(key)
+        if pool is None:
+            if mode == 'multithreading':
+                from multiprocessing.dummy import Pool as ThreadPool
+                pool = ThreadPool(processes=processes)
+            else:
+                from multiprocessing import Pool
+                pool = Pool(processes=processes)
+            _shared_pools[key] = pool
+    return pool
+
+
+def close_pools():
+    # 关闭所有共享池，之后再用到时会重新创建
+    with _shared_lock:
+        pools = list(_shared_pools.values())
+        _shared_pools.clear()
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+
+atexit.register(close_pools)
+
+
+# 自动确定区间大小时的上限
+MAX_CHUNKSIZE = 65536
+
+
+def _run_chunk(task):
+    # 在 worker 中执行一个连续区间，同时计时
+    func, start, end = task
+    tic = time.perf_counter()
+    result = func(start, end)
+    return result, time.perf_counter() - tic
+
+
 class AutoPool(object):
-    def __init__(self, mode, processes):
+    def __init__(self, mode, processes, chunksize=None):
 
         if mode == 'multiprocessing' and sys.platform == 'win32':
             warnings.warn('multiprocessing not support in windows, turning to multithreading')
@@ -20,19 +69,70 @@ class AutoPool(object):
 
         self.mode = mode
         self.processes = processes
+        self.chunksize = chunksize  # 每个任务处理的分块数，None 表示按分块数和 worker 数自动确定
+        self.chunk_timings = []  # 每个任务的 (start, end, 耗时秒数)
 
         if mode == 'vectorization':
-            pass
+            # 向量化模式由 WaterMarkCore 整批处理分块，这里只保留逐块 map 作为兜底
+            self._pool = CommonPool()
         elif mode == 'cached':
-            pass
-        elif mode == 'multithreading':
-            from multiprocessing.dummy import Pool as ThreadPool
-            self.pool = ThreadPool(processes=processes)
-        elif mode == 'multiprocessing':
-            from multiprocessing import Pool
-            self.pool = Pool(processes=processes)
+            # 缓存模式同样整批处理分块，额外复用 key_cache 中的分块打乱顺序
+            self._pool = CommonPool()
+        elif mode in ('multithreading', 'multiprocessing'):
+            # 用到时才从共享池里取，不在每个实例里 fork 新的进程池
+            self._pool = None
         else:  # common
-            self.pool = CommonPool()
+            self._pool = CommonPool()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            return get_shared_pool(self.mode, self.processes)
+        return self._pool
+
+    def start(self):
+        # 立即创建（或取得）共享池。多进程池要在批量处理启动其它线程之前 fork，
+        # 在多线程的父进程中 fork 时，子进程可能继承一把被其它线程持有的锁而永远等待
+        return self.pool
 
     def map(self, func, args):
         return self.pool.map(func, args)
+
+    @property
+    def n_workers(self):
+        if self._pool is None:
+            return self.processes or os.cpu_count() or 1
+        return 1
+
+    def chunk_ranges(self, size, chunksize=None):
+        # 把 [0, size) 切成连续区间，默认每个 worker 分到约 4 个任务，兼顾负载均衡和调度开销
+        # 每个区间最多 MAX_CHUNKSIZE 个分块，批量计算的临时数组不会随图片变大
+        size, chunksize = int(size), chunksize or self.chunksize
+        if not chunksize:
+            chunksize = min(max(-(-size // (self.n_workers * 4)), 256), MAX_CHUNKSIZE)
+        return [(start, min(start + chunksize, size)) for start in range(0, size, chunksize)]
+
+    def map_chunks(self, func, size, chunksize=None):
+        '''
+        :param func: func(start, end)，处理 [start, end) 区间的分块；多进程模式下必须可以 pickle
+        :param size: 分块总数
+        :return: 每个区间的返回值
+        '''
+        ranges = self.chunk_ranges(size, chunksize)
+        tmp = self.pool.map(_run_chunk, [(func, start, end) for start, end in ranges])
+        self.chunk_timings.extend((start, end, seconds) for (start, end), (_, seconds) in zip(ranges, tmp))
+        return [result for result, _ in tmp]
+
+    def reset_timings(self):
+        self.chunk_timings = []
+
+    def close(self):
+        # 不释放任何资源：共享池属于整个进程，其它实例可能正在使用，释放 worker 要调用 close_pools()，退出时也会自动关闭
+        # 保留这个方法和 with 语句，兼容原来的用法
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
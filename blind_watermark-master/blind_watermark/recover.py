@@ -1,41 +1,121 @@
 import cv2
 import numpy as np
 
-import functools
+import threading
+from collections import OrderedDict
+from multiprocessing.dummy import Pool as ThreadPool
 
 
-# 一个帮助缓存化加速的类，引入事实上的全局变量
-class MyValues:
-    def __init__(self):
-        self.idx = 0
-        self.image, self.template = None, None
+class FFTMatcher:
+    '''
+    基于 FFT 互相关的 TM_CCOEFF_NORMED 模板匹配，适合原图和 template 都很大的情况
+    原图的频谱和归一化用的积分图在第一次匹配时计算一次，之后与任意尺寸、任意多个 template 匹配时复用，
+    因此同一张原图应该只构造一个 FFTMatcher，在多个 scale、多张攻击图之间共用
+    金字塔搜索只用到某一层的 FFTMatcher，原分辨率的频谱和积分图不会被计算
+    只支持单通道（灰度）图片
+    '''
 
-    def set_val(self, image, template):
-        self.idx += 1
-        self.image, self.template = image, template
+    def __init__(self, image):
+        assert image.ndim == 2, 'FFTMatcher only supports grayscale images'
+        self.image = image
+        self.fft_shape = (cv2.getOptimalDFTSize(image.shape[0]), cv2.getOptimalDFTSize(image.shape[1]))
+        self.spectrum, self.sum, self.sq_sum = None, None, None
+        self._levels = {0: self}
+        self._lock = threading.Lock()
+        self._prepare_lock = threading.Lock()
 
+    @property
+    def shape(self):
+        return self.image.shape
 
-my_value = MyValues()
+    def _pad(self, img):
+        # 补零到最优 DFT 尺寸，只要 template 不比原图大，有效区域内的循环互相关不会发生回绕
+        padded = np.zeros(self.fft_shape, dtype=np.float32)
+        padded[:img.shape[0], :img.shape[1]] = img
+        return padded
 
+    def _prepare(self):
+        # 第一次匹配时才计算频谱和积分图（大图上需要数百 MB）
+        with self._prepare_lock:
+            if self.spectrum is None:
+                self.sum, self.sq_sum = cv2.integral2(self.image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+                self.spectrum = cv2.dft(self._pad(self.image))  # CCS 压缩格式的实数频谱
 
-@functools.lru_cache(maxsize=None, typed=False)
-def match_template(w, h, idx):
-    image, template = my_value.image, my_value.template
-    resized = cv2.resize(template, dsize=(w, h))
-    scores = cv2.matchTemplate(image, resized, cv2.TM_CCOEFF_NORMED)
-    ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
-    return ind, scores[ind]
+    def pyramid_level(self, level):
+        # 高斯金字塔第 level 层图片对应的 FFTMatcher，同样只构造一次，中间层不构造 FFTMatcher
+        with self._lock:
+            if level not in self._levels:
+                self._levels[level] = FFTMatcher(build_pyramid(self.image, level)[-1])
+            return self._levels[level]
+
+    def match_template(self, template):
+        # 结果与 cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED) 一致（浮点误差以内）
+        self._prepare()
+        h, w = template.shape[:2]
+        out_h, out_w = self.image.shape[0] - h + 1, self.image.shape[1] - w + 1
+
+        # 分子：template 去均值后与原图的互相关，窗口均值项因为 template 去均值而抵消
+        tem = template.astype(np.float32)
+        tem -= tem.mean()
+        tem_spectrum = cv2.dft(self._pad(tem), nonzeroRows=h)
+        corr = cv2.idft(cv2.mulSpectrums(self.spectrum, tem_spectrum, 0, conjB=True),
+                        flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)[:out_h, :out_w]
+
+        # 分母：由积分图得到每个窗口的方差
+        def window_sum(integral):
+            return integral[h:h + out_h, w:w + out_w] - integral[:out_h, w:w + out_w] \
+                - integral[h:h + out_h, :out_w] + integral[:out_h, :out_w]
+
+        win_sum = window_sum(self.sum)
+        win_var = np.maximum(window_sum(self.sq_sum) - win_sum ** 2 / (h * w), 0)
+        denom = np.sqrt(win_var * np.square(tem, dtype=np.float64).sum())
+        scores = np.zeros((out_h, out_w))
+        np.divide(corr, denom, out=scores, where=denom > 1e-6)
+        return scores
+
+
+def match_template(image, template, fft_matcher=None):
+    # fft_matcher 不为空时，用它缓存的原图频谱计算，否则用 cv2.matchTemplate
+    if fft_matcher is not None:
+        return fft_matcher.match_template(template)
+    return cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
 
 
-def match_template_by_scale(scale):
-    image, template = my_value.image, my_value.template
-    w, h = round(template.shape[1] * scale), round(template.shape[0] * scale)
-    ind, score = match_template(w, h, idx=my_value.idx)
-    return ind, score, scale
+class MatchCache:
+    # 一次搜索对应一个实例，缓存 template 缩放到各个尺寸后的匹配结果
+    # 缓存有上限（LRU 淘汰），不同的搜索之间互不干扰，可以在多个线程中同时搜索
+    def __init__(self, image, template, maxsize=1024, fft_matcher=None):
+        self.image, self.template = image, template
+        self.maxsize = maxsize
+        self.fft_matcher = fft_matcher
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match_template(self, w, h):
+        with self._lock:
+            if (w, h) in self._cache:
+                self._cache.move_to_end((w, h))
+                return self._cache[(w, h)]
+
+        resized = cv2.resize(self.template, dsize=(w, h))
+        scores = match_template(self.image, resized, self.fft_matcher)
+        ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
+        result = ind, scores[ind]
+
+        with self._lock:
+            self._cache[(w, h)] = result
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return result
 
+    def match_template_by_scale(self, scale):
+        w, h = round(self.template.shape[1] * scale), round(self.template.shape[0] * scale)
+        ind, score = self.match_template(w, h)
+        return ind, score, scale
 
-def search_template(scale=(0.5, 2), search_num=200):
-    image, template = my_value.image, my_value.template
+
+def search_template(match_cache, scale=(0.5, 2), search_num=200):
+    image, template = match_cache.image, match_cache.template
     # 局部暴力搜索算法，寻找最优的scale
     tmp = []
     min_scale, max_scale = scale
@@ -46,7 +126,7 @@ def search_template(scale=(0.5, 2), search_num=200):
 
     for i in range(2):
         for scale in np.linspace(min_scale, max_scale, search_num):
-            ind, score, scale = match_template_by_scale(scale)
+            ind, score, scale = match_cache.match_template_by_scale(scale)
             tmp.append([ind, score, scale])
 
         # 寻找最佳
@@ -63,23 +143,128 @@ def search_template(scale=(0.5, 2), search_num=200):
     return tmp[max_idx]
 
 
+def build_pyramid(img, levels):
+    # 高斯金字塔，pyramid[i] 是缩小 2^i 倍的图片
+    pyramid = [img]
+    for _ in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def match_in_window(image, template, w, h, window=None, fft_matcher=None):
+    # 把 template 缩放到 (w, h) 后在 image 中匹配，window=(x1, y1, x2, y2) 时只在这个范围内搜索
+    # 小窗口内的匹配直接用 cv2，fft_matcher 只用于全图匹配
+    x1, y1 = 0, 0
+    if window is not None:
+        x1, y1 = max(window[0], 0), max(window[1], 0)
+        image = image[y1:max(window[3], 0), x1:max(window[2], 0)]
+    if w < 1 or h < 1 or image.shape[0] < h or image.shape[1] < w:
+        return (y1, x1), -1
+    resized = cv2.resize(template, dsize=(w, h))
+    scores = match_template(image, resized, fft_matcher if window is None else None)
+    ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
+    return (ind[0] + y1, ind[1] + x1), scores[ind]
+
+
+def unique_size_scales(template, scales):
+    # 缩放后尺寸相同的 scale 只保留最大的一个：匹配结果相同，而按 int(尺寸 * scale) 得到的位置不会比匹配的尺寸小
+    # scales 升序时最后一个一定保留，因此 scale 范围的上限总会被尝试
+    sizes = dict()
+    for scale in scales:
+        sizes[(round(template.shape[1] * scale), round(template.shape[0] * scale))] = scale
+    return sorted(sizes.values())
+
+
+def search_template_pyramid(image, template, scale=(0.5, 2), search_num=200, min_size=32, workers=None,
+                            fft_matcher=None):
+    '''
+    由粗到细的 scale 搜索：
+    1. 在高斯金字塔的低分辨率层上，对 search_num 个 scale 做全图匹配，缩放后尺寸相同的 scale 只算一次
+    2. 回到原分辨率，在最佳 scale 的相邻区间内逐像素细分 scale，只在粗搜索位置附近的小窗口内匹配
+    每一步的候选 scale 都在线程池中并发计算（cv2 计算时会释放 GIL）
+    :param min_size: 低分辨率层上，template 最短边缩放后不少于 min_size 像素
+    :param fft_matcher: 原图的 FFTMatcher，不为空时粗搜索用 FFT 互相关
+    :return: (ind, score, scale)
+    '''
+    min_scale, max_scale = scale
+    max_scale = min(max_scale, image.shape[0] / template.shape[0], image.shape[1] / template.shape[1])
+
+    levels = max(0, int(np.log2(max(min(template.shape[:2]) * min_scale / min_size, 1))))
+    fft_matcher_l = fft_matcher.pyramid_level(levels) if fft_matcher is not None else None
+    image_l = fft_matcher_l.image if fft_matcher_l is not None else build_pyramid(image, levels)[-1]
+    template_l = build_pyramid(template, levels)[-1]
+    factor = 2 ** levels
+
+    # 粗搜索
+    coarse_scales = unique_size_scales(template_l, np.linspace(min_scale, max_scale, search_num))
+
+    with ThreadPool(processes=workers) as pool:
+        tmp = pool.map(lambda scale: match_in_window(image_l, template_l, round(template_l.shape[1] * scale),
+                                                     round(template_l.shape[0] * scale), fft_matcher=fft_matcher_l),
+                       coarse_scales)
+        max_idx = int(np.argmax([score for ind, score in tmp]))
+        y_l, x_l = tmp[max_idx][0]
+
+        # 细搜索，最佳 scale 在两端时一直搜到 scale 范围的端点
+        fine_min = coarse_scales[max_idx - 1] if max_idx > 0 else min_scale
+        fine_max = coarse_scales[max_idx + 1] if max_idx < len(coarse_scales) - 1 else max_scale
+        search_num = 2 * int((fine_max - fine_min) * max(template.shape[1], template.shape[0])) + 1
+        margin = 2 * factor + 2
+
+        def match_fine(scale):
+            w, h = round(template.shape[1] * scale), round(template.shape[0] * scale)
+            window = (x_l * factor - margin, y_l * factor - margin, x_l * factor + w + margin, y_l * factor + h + margin)
+            ind, score = match_in_window(image, template, w, h, window)
+            return ind, score, scale
+
+        tmp = pool.map(match_fine, unique_size_scales(template, np.linspace(fine_min, fine_max, search_num)))
+
+    return tmp[int(np.argmax([score for ind, score, scale in tmp]))]
+
+
 def estimate_crop_parameters(original_file=None, template_file=None, ori_img=None, tem_img=None
-                             , scale=(0.5, 2), search_num=200):
+                             , scale=(0.5, 2), search_num=200, search='pyramid', workers=None, backend='opencv'):
+    '''
+    :param search: 'pyramid' or 'brute'
+        'pyramid' searches coarse-to-fine on an image pyramid, 'brute' is the original full-resolution search
+    :param workers: int or None
+        Number of threads scoring scale candidates in 'pyramid' search, None means cpu count
+    :param backend: 'opencv', 'fft' or a FFTMatcher
+        'fft' matches by FFT cross-correlation on the cached spectrum of the original. It only speeds up the
+        full-image matches: search='brute' and scale=(1, 1). With search='pyramid' only the coarse level is
+        matched by FFT (the fine stage matches small windows with cv2), so the gain there is small.
+        To match many templates against the same original, build FFTMatcher(ori_img) once and pass it here
+    '''
+
     # 推测攻击后的图片，在原图片中的位置、大小
     if template_file:
         tem_img = cv2.imread(template_file, cv2.IMREAD_GRAYSCALE)  # template image
     if original_file:
         ori_img = cv2.imread(original_file, cv2.IMREAD_GRAYSCALE)  # image
 
+    fft_matcher = None
+    if isinstance(backend, FFTMatcher):
+        fft_matcher = backend
+        if ori_img is None:
+            ori_img = fft_matcher.image
+        assert fft_matcher.shape == ori_img.shape, 'FFTMatcher is built for another original image'
+    elif backend == 'fft':
+        fft_matcher = FFTMatcher(ori_img)
+
     if scale[0] == scale[1] == 1:
         # 不缩放
         scale_infer = 1
-        scores = cv2.matchTemplate(ori_img, tem_img, cv2.TM_CCOEFF_NORMED)
+        scores = match_template(ori_img, tem_img, fft_matcher)
         ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
         ind, score = ind, scores[ind]
     else:
-        my_value.set_val(image=ori_img, template=tem_img)
-        ind, score, scale_infer = search_template(scale=scale, search_num=search_num)
+        if search == 'pyramid':
+            ind, score, scale_infer = search_template_pyramid(ori_img, tem_img, scale=scale, search_num=search_num,
+                                                              workers=workers, fft_matcher=fft_matcher)
+        else:
+            ind, score, scale_infer = search_template(MatchCache(image=ori_img, template=tem_img,
+                                                                 fft_matcher=fft_matcher),
+                                                      scale=scale, search_num=search_num)
     w, h = int(tem_img.shape[1] * scale_infer), int(tem_img.shape[0] * scale_infer)
     x1, y1, x2, y2 = ind[1], ind[0], ind[1] + w, ind[0] + h
     return (x1, y1, x2, y2), ori_img.shape, score, scale_infer
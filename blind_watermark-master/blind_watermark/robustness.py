@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 鲁棒性测试：对同一张嵌入了水印的图片施加一组攻击（剪切、缩放、亮度、遮挡、椒盐、旋转、JPEG），
+# 全部在内存中进行，多个攻击的提取并发执行，报告每种攻击下的误码率（BER）
+#
+# python -m blind_watermark.robustness image.jpg
+# python -m blind_watermark.robustness --size 1080p --channels Y --fast -o robustness.csv
+import csv
+import json
+import sys
+import time
+from optparse import OptionParser
+
+import cv2
+import numpy as np
+
+from .att import AttackChain
+from .bench import parse_size, synthetic_image
+from .blind_watermark import WaterMark, imap_unordered
+from .bwm_core import one_dim_kmeans
+from .version import bw_notes
+
+
+def to_uint8(img):
+    # 攻击后的图片按保存成文件时的样子取整，自定义的攻击函数可能返回 float
+    if img.dtype == np.uint8:
+        return img
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+def attack_grid():
+    '''
+    默认的攻击组合，几何攻击之后按已知参数还原到原尺寸
+    :return: list of (name, func), func(img, seed) returns the attacked image with the same shape as img
+    '''
+    crop1, crop2 = ((0.1, 0.1), (0.9, 0.9)), ((0.25, 0.25), (0.75, 0.75))
+    return [
+        ('none', lambda img, seed: img),
+        ('crop 80% x0.7', AttackChain().crop(loc_r=crop1).resize(scale=0.7).recover_crop(loc_r=crop1)),
+        ('crop 50% x1.5', AttackChain().crop(loc_r=crop2).resize(scale=1.5).recover_crop(loc_r=crop2)),
+        ('resize x0.5', AttackChain().resize(scale=0.5).resize()),
+        ('resize x0.75', AttackChain().resize(scale=0.75).resize()),
+        ('bright x0.8', AttackChain().bright(0.8).bright(1 / 0.8)),
+        ('bright x1.2', AttackChain().bright(1.2).bright(1 / 1.2)),
+        ('shelter 3x10%', AttackChain().shelter(ratio=0.1, n=3)),
+        ('shelter 6x10%', AttackChain().shelter(ratio=0.1, n=6)),
+        ('salt_pepper 1%', AttackChain().salt_pepper(ratio=0.01)),
+        ('salt_pepper 5%', AttackChain().salt_pepper(ratio=0.05)),
+        ('rot 10', AttackChain().rot(10).rot(-10)),
+        ('rot 45', AttackChain().rot(45).rot(-45)),
+        ('jpeg 90', AttackChain().jpeg(quality=90)),
+        ('jpeg 70', AttackChain().jpeg(quality=70)),
+        ('jpeg 50', AttackChain().jpeg(quality=50)),
+        ('crop x0.7 + jpeg 70', AttackChain().crop(loc_r=crop1).resize(scale=0.7).jpeg(quality=70)
+         .recover_crop(loc_r=crop1)),
+    ]
+
+
+def evaluate(bwm, embed_img, attacks=None, workers=None, seed=0):
+    '''
+    对 embed_img 施加每种攻击并提取水印，与 bwm 中读入的水印逐 bit 比较
+    :param bwm: WaterMark
+        The WaterMark that embedded embed_img, read_wm must have been called
+    :param embed_img: uint8 array
+    :param attacks: list of (name, func) or None for attack_grid()
+        func(img, seed) returns the attacked image, e.g. an att.AttackChain. Each func is called once,
+        from one thread, so an AttackChain must not appear twice in the list
+    :param workers: int or None
+        Number of attacks evaluated concurrently, None means cpu count
+    :param seed: int
+        Seed of the random attacks, the same seed gives the same attacked images
+    :return: list of dict(attack, ber, bit_errors, raw_ber, confidence, seconds), in the order of attacks.
+        ber and bit_errors are of the decoded watermark, raw_ber of the embedded bits before ecc decoding
+        (the same as ber without ecc). If an attack failed, ber is 1 and error holds the message
+    '''
+    assert bwm.wm_bit is not None, 'read_wm before evaluate'
+    attacks = attack_grid() if attacks is None else attacks
+    # bwm.wm_bit 是加密后的顺序，与解密前的提取结果直接比较，误码率相同
+    wm_bit = np.asarray(bwm.wm_bit).astype(bool)
+    payload_bit = bwm.payload_bit
+
+    def evaluate_one(item):
+        i, (name, func) = item
+        tic = time.perf_counter()
+        try:
+            attacked = to_uint8(func(embed_img, seed + i))
+            bwm_core = bwm.bwm_core.clone()
+            wm_avg, bit_confidence = bwm_core.extract_with_confidence(img=attacked, wm_shape=wm_bit.size)
+            raw_ber = float((one_dim_kmeans(wm_avg) != wm_bit).mean())
+            wm = bwm.decode_wm(wm_avg, wm_bit.size, 'bit')
+            bit_errors = int(((np.asarray(wm) >= 0.5) != payload_bit).sum())
+            return i, dict(attack=name, ber=bit_errors / payload_bit.size, bit_errors=bit_errors, raw_ber=raw_ber,
+                           confidence=float(bit_confidence.mean()), seconds=time.perf_counter() - tic)
+        except Exception as e:
+            return i, dict(attack=name, ber=1.0, bit_errors=payload_bit.size, raw_ber=1.0, confidence=0.0,
+                           seconds=time.perf_counter() - tic, error=str(e) or repr(e))
+
+    bwm.bwm_core.pool.start()  # 在单线程时创建多进程池，见 AutoPool.start
+    results = [None] * len(attacks)
+    for i, result in imap_unordered(evaluate_one, enumerate(attacks), workers):
+        results[i] = result
+    return results
+
+
+FIELDS = ('attack', 'ber', 'bit_errors', 'raw_ber', 'confidence', 'seconds', 'error')
+
+
+def write_results(filename, results):
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    opt_parser = OptionParser(usage='python -m blind_watermark.robustness [options] [image]')
+    opt_parser.add_option('--size', default='1080p',
+                          help='Size of the synthetic image used when no image is given, see blind_watermark.bench')
+    opt_parser.add_option('--wm', default='@guofei9987 开源万岁！', help='Watermark text')
+    opt_parser.add_option('-p', '--pwd', dest='password', type='int', default=1, help='password, like 1234')
+    opt_parser.add_option('--mode', default='vectorization', help='AutoPool mode used by each extraction')
+    opt_parser.add_option('--channels', default='YUV', help="YUV channels that carry the watermark, like 'Y'")
+    opt_parser.add_option('--fast', dest='fast_mode', action='store_true', default=False, help='Fast mode')
+    opt_parser.add_option('--ecc', action='store_true', default=False, help='Convolutional code with Viterbi decoding')
+    opt_parser.add_option('--d1', type='float', help='Quantization step d1, default 36')
+    opt_parser.add_option('--d2', type='float', help='Quantization step d2, default 20')
+    opt_parser.add_option('--workers', type='int', help='Number of attacks evaluated concurrently')
+    opt_parser.add_option('--seed', type='int', default=0, help='Seed of the random attacks')
+    opt_parser.add_option('-o', '--output', help='Write results to a .json or .csv file')
+    opts, args = opt_parser.parse_args(argv)
+
+    bw_notes.close()
+    if args:
+        img = cv2.imread(args[0], flags=cv2.IMREAD_COLOR)
+        assert img is not None, '{} not read'.format(args[0])
+    else:
+        img = synthetic_image(*parse_size(opts.size))
+
+    with WaterMark(password_img=opts.password, mode=opts.mode, channels=opts.channels,
+                   fast_mode=opts.fast_mode, ecc=opts.ecc) as bwm:
+        if opts.d1 is not None:
+            bwm.bwm_core.d1 = opts.d1
+        if opts.d2 is not None:
+            bwm.bwm_core.d2 = opts.d2
+        bwm.read_wm(opts.wm, mode='str')
+        bwm.read_img(img=img)
+        embed_img = to_uint8(bwm.embed())
+        psnr = cv2.PSNR(img[:, :, :3], embed_img[:, :, :3])
+
+        tic = time.perf_counter()
+        results = evaluate(bwm, embed_img, workers=opts.workers, seed=opts.seed)
+        seconds = time.perf_counter() - tic
+
+    print('image {}x{}, {} bits embedded, psnr {:.2f}'.format(img.shape[0], img.shape[1], bwm.wm_size, psnr))
+    print('{:<22} {:>8} {:>6} {:>8} {:>10} {:>8}'.format('attack', 'ber', 'errors', 'raw_ber', 'confidence',
+                                                         'seconds'))
+    for row in results:
+        print('{attack:<22} {ber:>8.4f} {bit_errors:>6} {raw_ber:>8.4f} {confidence:>10.4f} {seconds:>8.3f} {error}'
+              .format(error=row.get('error', ''), **row))
+    print('total {:.3f} seconds'.format(seconds))
+    sys.stdout.flush()
+    if opts.output:
+        write_results(opts.output, results)
+        print('Results written to', opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 多进程模式下的分块传输：把分块和打乱顺序放进共享内存，worker 按连续区间就地处理，
+# 结果直接写回共享内存，不再逐块 pickle
+import functools
+
+import numpy as np
+
+from .block_batch import add_wm_batch, get_wm_batch
+from .header import bit_index
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+def _attach(name):
+    # 挂载方不负责回收，不能注册到 resource_tracker，否则 worker 会误删主进程的共享内存或报泄漏
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 挂载时也会注册，这里临时跳过（只在单线程的 worker 进程里调用）
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedArray:
+    # 放在共享内存中的 ndarray，主进程创建，worker 按 name 挂载
+    def __init__(self, shape, dtype, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        if name is None:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.arr = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, arr):
+        # arr 为 None 时（例如 fast_mode 不打乱分块）返回 NoneArray，不占用共享内存
+        if arr is None:
+            return NoneArray()
+        obj = cls(arr.shape, arr.dtype)
+        obj.arr[...] = arr
+        return obj
+
+    @classmethod
+    def attach(cls, spec):
+        if spec is None:
+            return NoneArray()
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def spec(self):
+        return self.name, self.shape, self.dtype.str
+
+    def slice(self, start, end):
+        return self.arr[start:end]
+
+    def close(self):
+        self.arr = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+class NoneArray:
+    # 占位，代替值为 None 的 SharedArray
+    def spec(self):
+        return None
+
+    def slice(self, start, end):
+        return None
+
+    def close(self):
+        pass
+
+    def unlink(self):
+        pass
+
+
+def _embed_range(start, end, blocks_spec, shuffle_spec, wm_bit, d1, d2, wm_size, header):
+    blocks, shuffle = SharedArray.attach(blocks_spec), SharedArray.attach(shuffle_spec)
+    try:
+        wm_bits = wm_bit[bit_index(np.arange(start, end), wm_size, header)]
+        blocks.arr[start:end] = add_wm_batch(blocks.arr[start:end], shuffle.slice(start, end), wm_bits, d1, d2)
+    finally:
+        blocks.close()
+        shuffle.close()
+
+
+def _extract_range(start, end, blocks_spec, shuffle_spec, out_spec, d1, d2):
+    blocks, shuffle, out = SharedArray.attach(blocks_spec), SharedArray.attach(shuffle_spec), \
+        SharedArray.attach(out_spec)
+    try:
+        out.arr[..., start:end] = get_wm_batch(blocks.arr[..., start:end, :, :], shuffle.slice(start, end), d1, d2)
+    finally:
+        blocks.close()
+        shuffle.close()
+        out.close()
+
+
+def embed_shared(pool, ca_block, idx_shuffle, wm_bit, d1, d2, wm_size=None, header=False):
+    '''
+    :param pool: AutoPool，多进程模式
+    :param ca_block: (行数, 列数, h, w) 一个 channel 的四维分块，可以是 ca 上的视图，嵌入结果就地写回
+    :param wm_bit: 嵌入序列，带头部时是头部再接水印，分块对应的 bit 见 header.bit_index
+    '''
+    rows, cols, h, w = ca_block.shape
+    shm_blocks = SharedArray((rows * cols, h, w), ca_block.dtype)
+    shm_blocks.arr.reshape(ca_block.shape)[...] = ca_block
+    shm_shuffle = SharedArray.from_array(idx_shuffle)
+    try:
+        pool.map_chunks(functools.partial(_embed_range, blocks_spec=shm_blocks.spec(), shuffle_spec=shm_shuffle.spec(),
+                                          wm_bit=np.asarray(wm_bit), d1=d1, d2=d2,
+                                          wm_size=wm_size or np.size(wm_bit), header=header),
+                        size=rows * cols)
+        ca_block[...] = shm_blocks.arr.reshape(ca_block.shape)
+    finally:
+        shm_blocks.unlink()
+        shm_shuffle.unlink()
+
+
+def extract_shared(pool, ca_block, idx_shuffle, d1, d2):
+    '''
+    :param ca_block: (C, 行数, 列数, h, w) 多个 channel 的五维分块
+    :return: (C, N) 每个分块提取的 bit
+    '''
+    channels, rows, cols, h, w = ca_block.shape
+    shm_blocks = SharedArray((channels, rows * cols, h, w), ca_block.dtype)
+    shm_blocks.arr.reshape(ca_block.shape)[...] = ca_block
+    shm_shuffle = SharedArray.from_array(idx_shuffle)
+    shm_out = SharedArray((channels, rows * cols), np.float64)
+    try:
+        pool.map_chunks(functools.partial(_extract_range, blocks_spec=shm_blocks.spec(),
+                                          shuffle_spec=shm_shuffle.spec(), out_spec=shm_out.spec(), d1=d1, d2=d2),
+                        size=rows * cols)
+        return shm_out.arr.copy()
+    finally:
+        shm_blocks.unlink()
+        shm_shuffle.unlink()
+        shm_out.unlink()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 分阶段的耗时/内存统计：imread、颜色空间转换、dwt2、分块、每个 channel 的分块处理、idwt2、clip、imwrite
+# 默认不开启（NULL_STATS 什么也不做），传 stats 给 WaterMark.read_img/embed/extract 时才记录，
+# 用于判断一次慢请求是慢在 I/O、变换，还是 worker 池的调度
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageStats:
+    '''
+    :param callback: func(name, seconds, peak_bytes) or None
+        Called at the end of every stage, peak_bytes is None unless trace_memory
+    :param trace_memory: bool
+        Also record memory allocated in each stage via tracemalloc (starts it if not running, slows things down).
+        Call stop() to stop tracemalloc afterwards
+    '''
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = OrderedDict()  # name -> dict(calls, seconds, work_seconds, peak_bytes, net_bytes)
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    @contextmanager
+    def stage(self, name):
+        # 各阶段不嵌套，内存峰值用 reset_peak 按阶段统计
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):  # python >= 3.9
+                tracemalloc.reset_peak()
+            mem_before = tracemalloc.get_traced_memory()[0]
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - tic
+            peak_bytes = net_bytes = None
+            if self.trace_memory:
+                mem_after, mem_peak = tracemalloc.get_traced_memory()
+                peak_bytes, net_bytes = max(mem_peak - mem_before, 0), mem_after - mem_before
+            self.record(name, seconds, peak_bytes=peak_bytes, net_bytes=net_bytes)
+
+    def record(self, name, seconds, work_seconds=None, peak_bytes=None, net_bytes=None):
+        with self._lock:
+            item = self.stages.setdefault(name, dict(calls=0, seconds=0.0, work_seconds=None,
+                                                     peak_bytes=None, net_bytes=None))
+            item['calls'] += 1
+            item['seconds'] += seconds
+            if work_seconds is not None:
+                item['work_seconds'] = (item['work_seconds'] or 0.0) + work_seconds
+            if peak_bytes is not None:
+                item['peak_bytes'] = max(item['peak_bytes'] or 0, peak_bytes)
+                item['net_bytes'] = (item['net_bytes'] or 0) + net_bytes
+        if self.callback is not None:
+            self.callback(name, seconds, peak_bytes)
+
+    def add_work(self, name, chunk_timings):
+        # 分块处理阶段里 worker 实际计算的总耗时，阶段耗时与它（除以 worker 数）的差就是池的调度开销
+        if not chunk_timings:  # common 模式逐块处理，没有分块计时
+            return
+        self.stages[name]['work_seconds'] = (self.stages[name]['work_seconds'] or 0.0) \
+            + sum(seconds for _, _, seconds in chunk_timings)
+
+    @property
+    def total_seconds(self):
+        return sum(item['seconds'] for item in self.stages.values())
+
+    def as_dict(self):
+        return OrderedDict((name, dict(item)) for name, item in self.stages.items())
+
+    def summary(self):
+        lines = ['{:<16} {:>6} {:>10} {:>10} {:>12}'.format('stage', 'calls', 'seconds', 'work', 'peak MB')]
+        for name, item in self.stages.items():
+            lines.append('{:<16} {:>6} {:>10.4f} {:>10} {:>12}'.format(
+                name, item['calls'], item['seconds'],
+                '' if item['work_seconds'] is None else '{:.4f}'.format(item['work_seconds']),
+                '' if item['peak_bytes'] is None else '{:.1f}'.format(item['peak_bytes'] / 2 ** 20)))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.trace_memory = False
+
+    def __repr__(self):
+        return self.summary()
+
+
+class NullContext:
+    # 什么都不做的 with 语句，contextlib.nullcontext 要 Python 3.7 才有
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class NullStats:
+    # 不统计时的占位，开销只有一次函数调用
+    _null = NullContext()
+
+    def stage(self, name):
+        return self._null
+
+    def record(self, *args, **kwargs):
+        pass
+
+    def add_work(self, name, chunk_timings):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+def as_stats(stats):
+    '''
+    :param stats: None, True, a StageStats, or a callback func(name, seconds, peak_bytes)
+    :return: NULL_STATS for None, otherwise a StageStats
+    '''
+    if stats is None or stats is False:
+        return NULL_STATS
+    if stats is True:
+        return StageStats()
+    if isinstance(stats, (StageStats, NullStats)):
+        return stats
+    return StageStats(callback=stats)
@@ -5,6 +5,8 @@ import cv2
 import numpy as np
 from blind_watermark import WaterMark
 
+MODE_NAMES = {"str": "文本", "img": "图片", "bit": "二进制"}
+
 
 class BlindWatermarkGUI:
     def __init__(self, root):
@@ -22,6 +24,9 @@ class BlindWatermarkGUI:
         self.wm_shape = tk.StringVar(value="128,128")  # 图片水印形状，文本水印为长度
         self.wm_mode = tk.StringVar(value="str")
         #str / img / bit
+        self.fast_mode = tk.BooleanVar(value=False)  # 快速模式，嵌入和提取需一致
+        self.header = tk.BooleanVar(value=False)  # 嵌入自描述头，提取时不需要填写水印形状/长度
+        self.ecc = tk.BooleanVar(value=False)  # 纠错编码（文本/二进制水印），嵌入和提取需一致
 
         self.create_widgets()
 
@@ -79,13 +84,23 @@ class BlindWatermarkGUI:
         ttk.Label(parent, text="水印密码:").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
         ttk.Entry(parent, textvariable=self.password_wm).grid(row=4, column=1, padx=5, pady=5, sticky=tk.W)
 
+        # 快速模式、自描述头、纠错编码
+        option_frame = ttk.Frame(parent)
+        option_frame.grid(row=5, column=1, padx=5, pady=5, sticky=tk.W)
+        ttk.Checkbutton(option_frame, text="快速模式（更快，鲁棒性略低，提取时也需勾选）",
+                        variable=self.fast_mode).pack(side=tk.LEFT)
+        ttk.Checkbutton(option_frame, text="自描述头（提取时无需长度）",
+                        variable=self.header).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(option_frame, text="纠错编码（更抗攻击，水印长度约翻倍）",
+                        variable=self.ecc).pack(side=tk.LEFT)
+
         # 输出路径
-        ttk.Label(parent, text="输出图片路径:").grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
-        ttk.Entry(parent, textvariable=self.output_img_path, width=50).grid(row=5, column=1, padx=5, pady=5)
-        ttk.Button(parent, text="浏览", command=self.browse_output_img).grid(row=5, column=2, padx=5, pady=5)
+        ttk.Label(parent, text="输出图片路径:").grid(row=6, column=0, padx=5, pady=5, sticky=tk.W)
+        ttk.Entry(parent, textvariable=self.output_img_path, width=50).grid(row=6, column=1, padx=5, pady=5)
+        ttk.Button(parent, text="浏览", command=self.browse_output_img).grid(row=6, column=2, padx=5, pady=5)
 
         # 嵌入按钮
-        ttk.Button(parent, text="嵌入水印", command=self.embed_watermark).grid(row=6, column=1, padx=5, pady=20)
+        ttk.Button(parent, text="嵌入水印", command=self.embed_watermark).grid(row=7, column=1, padx=5, pady=20)
 
         # 绑定水印类型切换事件
         self.wm_mode.trace_add("write", self.update_wm_input)
@@ -117,17 +132,27 @@ class BlindWatermarkGUI:
         ttk.Label(parent, text="水印密码:").grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
         ttk.Entry(parent, textvariable=self.password_wm).grid(row=5, column=1, padx=5, pady=5, sticky=tk.W)
 
+        # 快速模式、自描述头、纠错编码
+        option_frame = ttk.Frame(parent)
+        option_frame.grid(row=6, column=1, padx=5, pady=5, sticky=tk.W)
+        ttk.Checkbutton(option_frame, text="快速模式（与嵌入时保持一致）",
+                        variable=self.fast_mode).pack(side=tk.LEFT)
+        ttk.Checkbutton(option_frame, text="自描述头（与嵌入时保持一致，无需填写形状/长度）",
+                        variable=self.header).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(option_frame, text="纠错编码（与嵌入时保持一致）",
+                        variable=self.ecc).pack(side=tk.LEFT)
+
         # 输出路径
-        ttk.Label(parent, text="提取结果路径:").grid(row=6, column=0, padx=5, pady=5, sticky=tk.W)
-        ttk.Entry(parent, textvariable=self.output_img_path, width=50).grid(row=6, column=1, padx=5, pady=5)
-        ttk.Button(parent, text="浏览", command=self.browse_extract_output).grid(row=6, column=2, padx=5, pady=5)
+        ttk.Label(parent, text="提取结果路径:").grid(row=7, column=0, padx=5, pady=5, sticky=tk.W)
+        ttk.Entry(parent, textvariable=self.output_img_path, width=50).grid(row=7, column=1, padx=5, pady=5)
+        ttk.Button(parent, text="浏览", command=self.browse_extract_output).grid(row=7, column=2, padx=5, pady=5)
 
         # 提取按钮
-        ttk.Button(parent, text="提取水印", command=self.extract_watermark).grid(row=7, column=1, padx=5, pady=20)
+        ttk.Button(parent, text="提取水印", command=self.extract_watermark).grid(row=8, column=1, padx=5, pady=20)
 
         # 提取结果显示
         self.extract_result = tk.Text(parent, height=5, width=60)
-        self.extract_result.grid(row=8, column=1, padx=5, pady=5)
+        self.extract_result.grid(row=9, column=1, padx=5, pady=5)
 
     def update_wm_input(self, *args):
         # 根据水印类型切换输入框
@@ -200,7 +225,10 @@ class BlindWatermarkGUI:
             # 初始化水印对象
             bwm = WaterMark(
                 password_img=int(self.password_img.get()),
-                password_wm=int(self.password_wm.get())
+                password_wm=int(self.password_wm.get()),
+                fast_mode=self.fast_mode.get(),
+                header=self.header.get(),
+                ecc=self.ecc.get()
             )
 
             # 读取原图
@@ -218,9 +246,11 @@ class BlindWatermarkGUI:
             bwm.embed(self.output_img_path.get())
 
             # 保存水印长度（文本/二进制）
-            if mode in ("str", "bit"):
+            if mode in ("str", "bit") and not self.header.get():
                 len_wm = len(bwm.wm_bit)
-                messagebox.showinfo("成功", f"水印嵌入成功！\n水印长度: {len_wm}\n(提取时需使用此长度)")
+                messagebox.showinfo("成功", f"水印嵌入成功！\n水印长度: {len_wm}\n(提取时需使用此长度)"
+                                    + ("\n(快速模式，提取时需勾选快速模式)" if self.fast_mode.get() else "")
+                                    + ("\n(纠错编码，提取时需勾选纠错编码)" if self.ecc.get() else ""))
             else:
                 messagebox.showinfo("成功", "水印嵌入成功！")
 
@@ -234,7 +264,7 @@ class BlindWatermarkGUI:
                 messagebox.showerror("错误", "请选择带水印图片路径")
                 return
 
-            if not self.wm_shape.get():
+            if not self.wm_shape.get() and not self.header.get():
                 messagebox.showerror("错误", "请输入水印形状/长度")
                 return
 
@@ -243,8 +273,10 @@ class BlindWatermarkGUI:
                 return
 
             mode = self.wm_mode.get()
-            # 解析水印形状
-            if mode == "img":
+            # 解析水印形状，带自描述头时从图片中读取
+            if self.header.get():
+                wm_shape = None
+            elif mode == "img":
                 try:
                     w, h = map(int, self.wm_shape.get().split(','))
                     wm_shape = (w, h)
@@ -261,35 +293,34 @@ class BlindWatermarkGUI:
             # 初始化水印对象
             bwm = WaterMark(
                 password_img=int(self.password_img.get()),
-                password_wm=int(self.password_wm.get())
+                password_wm=int(self.password_wm.get()),
+                fast_mode=self.fast_mode.get(),
+                header=self.header.get(),
+                ecc=self.ecc.get()
+            )
+
+            # 提取水印，图片水印直接保存到提取结果路径
+            wm_extract = bwm.extract(
+                filename=self.original_img_path.get(),
+                wm_shape=wm_shape,
+                out_wm_name=self.output_img_path.get(),
+                mode=mode
             )
+            # 带自描述头时水印类型以头部为准
+            if self.header.get() and bwm.last_header[1] != mode:
+                mode = bwm.last_header[1]
+                messagebox.showinfo("提示", f"自描述头中的水印类型为「{MODE_NAMES[mode]}」，已按该类型提取")
+                self.wm_mode.set(mode)
 
-            # 提取水印
             if mode == "img":
-                bwm.extract(
-                    filename=self.original_img_path.get(),
-                    wm_shape=wm_shape,
-                    out_wm_name=self.output_img_path.get(),
-                    mode="img"
-                )
                 messagebox.showinfo("成功", f"图片水印提取成功！\n已保存至: {self.output_img_path.get()}")
             elif mode == "str":
-                wm_extract = bwm.extract(
-                    filename=self.original_img_path.get(),
-                    wm_shape=wm_shape,
-                    mode="str"
-                )
                 self.extract_result.delete(1.0, tk.END)
                 self.extract_result.insert(tk.END, f"提取的文本水印:\n{wm_extract}")
                 with open(self.output_img_path.get(), 'w', encoding='utf-8') as f:
                     f.write(wm_extract)
                 messagebox.showinfo("成功", f"文本水印提取成功！\n已保存至: {self.output_img_path.get()}")
             elif mode == "bit":
-                wm_extract = bwm.extract(
-                    filename=self.original_img_path.get(),
-                    wm_shape=wm_shape,
-                    mode="bit"
-                )
                 # 转换为0/1
                 bit_str = ','.join(['1' if x >= 0.5 else '0' for x in wm_extract])
                 self.extract_result.delete(1.0, tk.END)
@@ -305,4 +336,4 @@ class BlindWatermarkGUI:
 if __name__ == "__main__":
     root = tk.Tk()
     app = BlindWatermarkGUI(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
\ No newline at end of file
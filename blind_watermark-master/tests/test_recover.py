@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+import pytest
+
+from blind_watermark import WaterMark, bw_notes
+from blind_watermark.bench import synthetic_image
+from blind_watermark.recover import estimate_crop_parameters, recover_crop
+
+bw_notes.close()
+
+
+@pytest.mark.parametrize('shape', [(600, 800), (480, 640), (720, 1280)])
+@pytest.mark.parametrize('search', ['pyramid', 'brute'])
+def test_same_size_template_is_full_frame(shape, search):
+    # 既没有剪切也没有缩放的图片，应当得到整幅图片的位置，scale 为 1
+    img = cv2.cvtColor(synthetic_image(*shape), cv2.COLOR_BGR2GRAY)
+    loc, image_o_shape, score, scale = estimate_crop_parameters(ori_img=img, tem_img=img, scale=(0.5, 2),
+                                                                search=search,
+                                                                search_num=200 if search == 'pyramid' else 40)
+    assert tuple(int(v) for v in loc) == (0, 0, shape[1], shape[0])
+    assert scale == 1
+    assert image_o_shape == shape
+
+
+def test_extract_after_recover_full_frame():
+    img = synthetic_image(600, 800)
+    bwm = WaterMark(password_img=1, password_wm=1)
+    bwm.read_wm('recover', mode='str')
+    bwm.read_img(img=img)
+    embed_img = np.rint(bwm.embed()).astype(np.uint8)
+
+    loc, image_o_shape, _, _ = estimate_crop_parameters(ori_img=cv2.cvtColor(img, cv2.COLOR_BGR2GRAY),
+                                                        tem_img=cv2.cvtColor(embed_img, cv2.COLOR_BGR2GRAY))
+    recovered = recover_crop(tem_img=embed_img, loc=loc, image_o_shape=image_o_shape)
+    wm = WaterMark(password_img=1, password_wm=1).extract(embed_img=np.rint(recovered).astype(np.uint8),
+                                                          wm_shape=len(bwm.wm_bit), mode='str')
+    assert wm == 'recover'